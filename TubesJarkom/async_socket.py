@@ -0,0 +1,347 @@
+import asyncio
+import errno
+import random
+import socket
+from typing import Optional, Tuple
+
+from custom_socket import (
+    SYN, ACK, PROBE, TIMEOUT, FIN_INTERVAL, RETRIES, CONGESTION_CONTROL, MAX_SEGMENT_SIZE,
+    MAX_SEGMENT_SIZE_LIMIT, HEADER_SIZE, RECEIVE_BUFFER_SIZE, PROBE_ATTEMPTS, MAX_HALF_OPEN,
+    KEEPALIVE_TIMEOUT, COALESCE_DELAY,
+    Segment, encode_options, decode_options, _ReliableConnection, _Endpoint, _set_dont_fragment,
+)
+
+
+class AsyncBetterUDPConnection(_ReliableConnection):
+    # One connection driven entirely from event loop callbacks: datagrams
+    # and call_later timers run the same protocol core as custom_socket's
+    # connections, and send() only awaits the future completed when its last
+    # segment is acknowledged. Either end can be a thread-based BetterUDPSocket.
+    log_tag = 'ASYNC'
+
+    def __init__(self, endpoint, addr, src_port, dest_port, seq_num, ack_num,
+                 negotiated_mss=MAX_SEGMENT_SIZE, congestion_control=CONGESTION_CONTROL,
+                 selective_repeat=False, sack=False, delayed_ack=True, coalesce=False,
+                 coalesce_delay=COALESCE_DELAY):
+        self.endpoint = endpoint
+        self.loop = endpoint.loop
+        self.addr = addr
+        self.src_port = src_port
+        self.dest_port = dest_port
+        self.connected = True
+
+        self.negotiated_mss = negotiated_mss
+        self.mss = MAX_SEGMENT_SIZE
+        self.congestion_control = congestion_control
+        self.selective_repeat = selective_repeat
+        self.sack = sack
+        self.delayed_ack = delayed_ack
+        self.coalesce = coalesce
+        self.coalesce_delay = coalesce_delay
+
+        self.message_queue: asyncio.Queue = asyncio.Queue()
+        self.probe_waiter: Optional[asyncio.Future] = None
+        self.probe_task: Optional[asyncio.Task] = None
+        self.fin_waiter: Optional[asyncio.Future] = None
+        self._init_transfer_state(seq_num, ack_num)
+        self._start_keepalive()
+
+    def _make_segment(self, flags, seq, ack, data=b'', prepared=None) -> Segment:
+        return Segment(flags, self.src_port, self.dest_port, seq, ack, data, prepared)
+
+    def _transmit(self, segment: Segment):
+        self.endpoint.transport.sendto(segment.pack(), self.addr)
+
+    def _call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    def _new_future(self):
+        return self.loop.create_future()
+
+    def _closed(self):
+        self.message_queue.put_nowait(None)
+        self.endpoint._forget(self)
+
+    def _fin_acked(self):
+        if self.fin_waiter is not None and not self.fin_waiter.done():
+            self.fin_waiter.set_result(True)
+
+    def _probe_acked(self, size):
+        if self.probe_waiter is not None and not self.probe_waiter.done():
+            self.probe_waiter.set_result(size)
+
+    def _retry_probe(self, rtt):
+        self.probe_task = self.loop.create_task(self.probe_path_mtu(rtt))
+
+    async def send(self, data: bytes) -> bool:
+        return await self.send_nowait(data)
+
+    def send_nowait(self, data) -> asyncio.Future:
+        # Queues the message behind any others still in flight and returns a
+        # future that completes once it is ACKed; back-to-back messages share
+        # the window instead of waiting for each other
+        return self._send_message(data)
+
+    async def receive(self) -> Optional[bytes]:
+        # Messages that arrived before the peer closed are still delivered; None afterwards
+        message = await self.message_queue.get()
+        if message is None:
+            self.message_queue.put_nowait(None)
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        fin_segment = self._fin_segment()
+        if fin_segment is None:
+            return
+
+        print(f"[ASYNC {self.addr}] Closing connection")
+        self.fin_waiter = self.loop.create_future()
+
+        for attempt in range(RETRIES):
+            self._transmit(fin_segment)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.fin_waiter), FIN_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+        self._connection_closed()
+
+    # Path MTU probing, same PROBE exchange as BetterUDPSocket
+
+    async def probe_path_mtu(self, rtt):
+        sock = self.endpoint.transport.get_extra_info('socket')
+        dont_fragment = _set_dont_fragment(sock, True)
+        timeout, sizes = self._probe_plan(rtt, dont_fragment)
+        start_mss = self.mss
+
+        try:
+            for size in sizes:
+                if size <= self.mss:
+                    continue
+                if not await self._send_probe(size, timeout):
+                    break
+                self.mss = size
+        finally:
+            if dont_fragment:
+                _set_dont_fragment(sock, False)
+
+        self._probe_finished(rtt, start_mss)
+        print(f"[ASYNC {self.addr}] Segment size {self.mss} (negotiated {self.negotiated_mss})")
+
+    async def _send_probe(self, size, timeout) -> bool:
+        probe = self._make_segment(PROBE, 0, 0, bytes(size - HEADER_SIZE))
+
+        for attempt in range(PROBE_ATTEMPTS):
+            self.probe_waiter = self.loop.create_future()
+            self._transmit(probe)
+            try:
+                confirmed = await asyncio.wait_for(self.probe_waiter, timeout)
+            except asyncio.TimeoutError:
+                continue
+            return confirmed >= size
+        return False
+
+
+class AsyncBetterUDPSocket(asyncio.DatagramProtocol, _Endpoint):
+    # asyncio counterpart of BetterUDPSocket, sharing its handshake code.
+    # One datagram endpoint serves every connection from the event loop thread:
+    #
+    #     server = AsyncBetterUDPSocket()
+    #     await server.listen('127.0.0.1', 9000)
+    #     conn, addr = await server.accept()
+    #     async for message in conn: ...
+    #
+    # In client mode connect() makes send/receive/close and async iteration
+    # on the socket itself act on its one connection, as with BetterUDPSocket.
+
+    def __init__(self, max_segment_size=MAX_SEGMENT_SIZE_LIMIT, congestion_control=CONGESTION_CONTROL,
+                 selective_repeat=True, sack=True, delayed_ack=True,
+                 max_half_open=MAX_HALF_OPEN, syn_cookies=True, coalesce=False, coalesce_delay=COALESCE_DELAY):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.src_port = 0
+        self._init_endpoint(max_segment_size, congestion_control, selective_repeat, sack, delayed_ack,
+                            coalesce, coalesce_delay, max_half_open, syn_cookies)
+
+        # Server mode
+        self.server_mode = False
+        self.connection_queue: Optional[asyncio.Queue] = None
+
+        # Client mode
+        self.addr = None
+        self.seq_num = random.randint(1000, 9999)
+        self.connection: Optional[AsyncBetterUDPConnection] = None
+        self.synack_waiter: Optional[asyncio.Future] = None
+        self.final_ack: Optional[Segment] = None
+
+    def _send_to(self, segment, addr):
+        self.transport.sendto(segment.pack(), addr)
+
+    def _call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    def _open_connection(self, half_open, addr) -> AsyncBetterUDPConnection:
+        return AsyncBetterUDPConnection(
+            self, addr, self.src_port, half_open.client_port, half_open.server_seq + 1, half_open.client_seq,
+            half_open.negotiated_mss, self.congestion_control, half_open.selective_repeat,
+            half_open.sack, self.delayed_ack, half_open.coalesce, self.coalesce_delay
+        )
+
+    async def _open(self, local_addr):
+        self.loop = asyncio.get_running_loop()
+        await self.loop.create_datagram_endpoint(lambda: self, local_addr=local_addr)
+
+        try:
+            self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                                               RECEIVE_BUFFER_SIZE)
+        except OSError:
+            pass
+        self.src_port = self.transport.get_extra_info('sockname')[1]
+
+    async def listen(self, host: str, port: int):
+        await self._open((host, port))
+        self.server_mode = True
+        self.connection_queue = asyncio.Queue()
+        print(f"[SERVER] Listening on port {self.src_port}")
+
+    async def accept(self) -> Tuple[AsyncBetterUDPConnection, Tuple[str, int]]:
+        if not self.server_mode:
+            raise RuntimeError("Socket not in server mode. Call listen() first.")
+
+        connection = await self.connection_queue.get()
+        return connection, connection.addr
+
+    async def connect(self, ip_address: str, port: int):
+        await self._open(('0.0.0.0', 0))
+        self.addr = (ip_address, port)
+
+        syn_options = encode_options(self._handshake_options())
+        syn_segment = Segment(SYN, self.src_port, port, self.seq_num, 0, syn_options)
+        self.synack_waiter = self.loop.create_future()
+
+        for attempt in range(RETRIES):
+            sent_at = self.loop.time()
+            self.transport.sendto(syn_segment.pack(), self.addr)
+            print(f"[CLIENT] Sent SYN (seq={self.seq_num})")
+            try:
+                synack = await asyncio.wait_for(asyncio.shield(self.synack_waiter), TIMEOUT)
+                break
+            except asyncio.TimeoutError:
+                continue
+        else:
+            raise TimeoutError("Connection failed")
+
+        handshake_rtt = self.loop.time() - sent_at
+        negotiated_mss, selective_repeat, sack, coalesce = self._negotiate(decode_options(synack.data))
+
+        # Kept to answer SYN-ACK retransmissions if this ACK gets lost
+        self.final_ack = Segment(ACK, self.src_port, port, self.seq_num + 1, synack.seq + 1)
+        self.transport.sendto(self.final_ack.pack(), self.addr)
+
+        self.connection = AsyncBetterUDPConnection(
+            self, self.addr, self.src_port, port, self.seq_num + 1, synack.seq + 1, negotiated_mss,
+            self.congestion_control, selective_repeat, sack, self.delayed_ack, coalesce, self.coalesce_delay
+        )
+        self.connection.peer_confirmed = False
+        if attempt == 0:
+            self.connection.rtt.sample(handshake_rtt)
+        print(f"[CLIENT] Connected to {self.addr}")
+
+        if negotiated_mss > MAX_SEGMENT_SIZE:
+            await self.connection.probe_path_mtu(handshake_rtt)
+
+    def _client_connection(self) -> AsyncBetterUDPConnection:
+        if self.connection is None:
+            raise RuntimeError("Not connected")
+        return self.connection
+
+    async def send(self, data: bytes) -> bool:
+        return await self._client_connection().send(data)
+
+    def send_nowait(self, data) -> asyncio.Future:
+        return self._client_connection().send_nowait(data)
+
+    async def receive(self) -> Optional[bytes]:
+        return await self._client_connection().receive()
+
+    def idle_time(self) -> float:
+        return self._client_connection().idle_time()
+
+    def peer_alive(self, timeout: float = KEEPALIVE_TIMEOUT) -> bool:
+        return self._client_connection().peer_alive(timeout)
+
+    def __aiter__(self):
+        return self._client_connection()
+
+    async def close(self):
+        if self.server_mode:
+            await asyncio.gather(*(connection.close() for connection in self._close_listener()))
+        elif self.connection is not None:
+            await self.connection.close()
+
+        if self.transport is not None:
+            self.transport.close()
+
+    def _forget(self, connection):
+        if self.clients.get(connection.addr) is connection:
+            del self.clients[connection.addr]
+
+    # DatagramProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            segment = Segment.unpack(data)
+        except ValueError as e:
+            print(f"[RECV] Bad packet from {addr}: {e}")
+            return
+
+        if self.server_mode:
+            connection = self._route_server_segment(segment, addr)
+            if connection is not None:
+                connection.handle_segment(segment)
+        else:
+            self._handle_client_segment(segment, addr)
+
+    def error_received(self, exc):
+        if getattr(exc, 'errno', None) == errno.EMSGSIZE and self.connection is not None:
+            # The probe can't leave this host with DF set
+            self.connection._probe_acked(0)
+            return
+        print(f"[RECV] Socket error: {exc}")
+
+    def connection_lost(self, exc):
+        for connection in list(self.clients.values()):
+            connection._connection_closed()
+        if self.connection is not None:
+            self.connection._connection_closed()
+
+    # Client mode
+
+    def _handle_client_segment(self, segment, addr):
+        if addr != self.addr:
+            return
+
+        if (segment.flags & (SYN | ACK)) == (SYN | ACK):
+            if not self.synack_waiter.done():
+                if segment.ack == self.seq_num + 1:
+                    self.synack_waiter.set_result(segment)
+            elif self.final_ack is not None:
+                # The server is still waiting for our final ACK
+                self.transport.sendto(self.final_ack.pack(), self.addr)
+            return
+
+        if self.connection is not None:
+            self.connection.handle_segment(segment)
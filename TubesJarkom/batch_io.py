@@ -0,0 +1,300 @@
+import ctypes
+import errno
+import select
+import socket
+import struct
+import sys
+import threading
+from typing import List, Sequence, Tuple
+
+RECV_BATCH = 32  # datagrams per recvmmsg call
+SEND_BATCH = 64  # datagrams per sendmmsg call
+MAX_DATAGRAM = 65507
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+
+# UDP segmentation offload (Linux 4.18+) and receive coalescing (5.0+)
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+GSO_MAX_SEGMENTS = 64  # UDP_MAX_SEGMENTS: datagrams per GSO send
+GRO_BUFFER = 65535     # largest coalesced buffer the kernel hands over
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    libc.recvmmsg.restype = ctypes.c_int
+    libc.sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+HAVE_MMSG = _libc is not None
+
+
+def _probe_offload() -> Tuple[bool, bool]:
+    # Both options are plain setsockopts, so support is detected by trying them
+    if not sys.platform.startswith('linux') or not hasattr(socket.socket, 'sendmsg'):
+        return False, False
+    
+    supported = []
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for option, value in ((UDP_SEGMENT, 0), (UDP_GRO, 0)):
+            try:
+                probe.setsockopt(SOL_UDP, option, value)
+                supported.append(True)
+            except OSError:
+                supported.append(False)
+    finally:
+        probe.close()
+    return supported[0], supported[1]
+
+
+HAVE_GSO, HAVE_GRO = _probe_offload()
+
+
+def _fill_sockaddr(sockaddr: _SockAddrIn, addr):
+    # In place: send headers point at this struct
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port = socket.htons(addr[1])
+    sockaddr.sin_addr[:] = socket.inet_aton(addr[0])
+
+
+class DatagramIO:
+    # One datagram per syscall: the portable path, and the fallback when
+    # recvmmsg/sendmmsg aren't available. Both paths honour the socket's timeout.
+    batched = False
+
+    def configure(self, sock: socket.socket):
+        pass
+
+    def recv_batch(self, sock: socket.socket) -> List[Tuple[bytes, Tuple[str, int]]]:
+        return [sock.recvfrom(MAX_DATAGRAM)]
+
+    def send_batch(self, sock: socket.socket, datagrams: Sequence[bytes], addr) -> int:
+        for data in datagrams:
+            sock.sendto(data, addr)
+        return len(datagrams)
+
+
+class MMsgDatagramIO(DatagramIO):
+    # Linux fast path: a poll for readiness then one recvmmsg for everything
+    # queued, and one sendmmsg per window burst. IPv4 only, like the rest of
+    # the stack. Receive buffers belong to the single receiver thread and are
+    # only allocated once it first reads; send headers are per sending thread.
+    batched = True
+
+    def __init__(self, recv_batch_size: int = RECV_BATCH, send_batch_size: int = SEND_BATCH):
+        self.recv_batch_size = recv_batch_size
+        self.send_batch_size = send_batch_size
+        self.recv_headers = None
+        self.send_state = threading.local()
+
+    def _allocate_recv_buffers(self):
+        # recv_batch_size full-sized datagrams: about 2 MB with the defaults
+        recv_batch_size = self.recv_batch_size
+        self.recv_buffers = (ctypes.c_char * MAX_DATAGRAM * recv_batch_size)()
+        self.recv_iovecs = (_IoVec * recv_batch_size)()
+        self.recv_addrs = (_SockAddrIn * recv_batch_size)()
+        self.recv_headers = (_MMsgHdr * recv_batch_size)()
+        for i in range(recv_batch_size):
+            self.recv_iovecs[i].iov_base = ctypes.addressof(self.recv_buffers[i])
+            self.recv_iovecs[i].iov_len = MAX_DATAGRAM
+            self.recv_headers[i].msg_hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            self.recv_headers[i].msg_hdr.msg_iovlen = 1
+            self.recv_headers[i].msg_hdr.msg_name = ctypes.addressof(self.recv_addrs[i])
+            self.recv_headers[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+        self.recv_used = 0
+
+        # Byte views for copying out without a ctypes call per datagram, and
+        # raw sockaddr (port + address) -> (host, port) for the peers seen so far
+        self.recv_bytes = memoryview(self.recv_buffers).cast('B')
+        self.recv_addr_bytes = memoryview(self.recv_addrs).cast('B')
+        self.addr_cache = {}
+
+    def recv_batch(self, sock: socket.socket) -> List[Tuple[bytes, Tuple[str, int]]]:
+        timeout = sock.gettimeout()
+        if timeout is not None and not select.select([sock], [], [], timeout)[0]:
+            raise socket.timeout("timed out")
+        if self.recv_headers is None:
+            self._allocate_recv_buffers()
+
+        # The kernel shrinks msg_namelen to what it wrote; restore the ones used last time
+        addr_size = ctypes.sizeof(_SockAddrIn)
+        for i in range(self.recv_used):
+            self.recv_headers[i].msg_hdr.msg_namelen = addr_size
+
+        count = _libc.recvmmsg(sock.fileno(), self.recv_headers, self.recv_batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            self.recv_used = 0
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(error, "recvmmsg failed")
+        self.recv_used = count
+
+        datagrams = []
+        for i in range(count):
+            raw_addr = bytes(self.recv_addr_bytes[i * addr_size + 2:i * addr_size + 8])
+            addr = self.addr_cache.get(raw_addr)
+            if addr is None:
+                addr = (socket.inet_ntoa(raw_addr[2:]), int.from_bytes(raw_addr[:2], 'big'))
+                if len(self.addr_cache) < 65536:
+                    self.addr_cache[raw_addr] = addr
+
+            start = i * MAX_DATAGRAM
+            datagrams.append((bytes(self.recv_bytes[start:start + self.recv_headers[i].msg_len]), addr))
+        return datagrams
+
+    def _send_state(self, addr):
+        # Per thread: headers with one iovec each, all pointing at the same destination
+        state = self.send_state
+        if not hasattr(state, 'headers'):
+            state.headers = (_MMsgHdr * self.send_batch_size)()
+            state.iovecs = (_IoVec * self.send_batch_size)()
+            state.sockaddr = _SockAddrIn()
+            for i in range(self.send_batch_size):
+                state.headers[i].msg_hdr.msg_iov = ctypes.pointer(state.iovecs[i])
+                state.headers[i].msg_hdr.msg_iovlen = 1
+                state.headers[i].msg_hdr.msg_name = ctypes.addressof(state.sockaddr)
+                state.headers[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            state.addr = None
+        if state.addr != addr:
+            _fill_sockaddr(state.sockaddr, addr)
+            state.addr = addr
+        return state
+
+    def send_batch(self, sock: socket.socket, datagrams: Sequence[bytes], addr) -> int:
+        if len(datagrams) == 1:
+            sock.sendto(datagrams[0], addr)
+            return 1
+
+        state = self._send_state(addr)
+        iovecs = state.iovecs
+
+        sent = 0
+        while sent < len(datagrams):
+            batch = datagrams[sent:sent + self.send_batch_size]
+            # One copy of the batch, no bigger than it, that the iovecs point
+            # into; it has to stay referenced until sendmmsg returns
+            joined = b''.join(batch)
+            base = ctypes.cast(ctypes.c_char_p(joined), ctypes.c_void_p).value
+            offset = 0
+            for i, data in enumerate(batch):
+                size = len(data)
+                iovec = iovecs[i]
+                iovec.iov_base = base + offset
+                iovec.iov_len = size
+                offset += size
+
+            count = _libc.sendmmsg(sock.fileno(), state.headers, len(batch), MSG_DONTWAIT)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise OSError(error, "sendmmsg failed")
+                # Send buffer full: wait for room the way sendto() would
+                if not select.select([], [sock], [], sock.gettimeout())[1]:
+                    raise socket.timeout("timed out")
+                continue
+            sent += count
+        return sent
+
+
+class OffloadDatagramIO(DatagramIO):
+    # Linux UDP GSO/GRO: a run of equal-sized datagrams (the last may be
+    # shorter) goes down as one sendmsg with a UDP_SEGMENT size, and the kernel
+    # cuts it up; on receive, UDP_GRO hands over several datagrams of one flow
+    # glued together plus their size, which is split back apart here.
+    # Datagram boundaries on the wire are unchanged, so either end may use it
+    # without the other.
+    batched = True
+
+    def __init__(self, gso: bool = HAVE_GSO, gro: bool = HAVE_GRO):
+        self.gso = gso
+        self.gro = gro
+
+    def configure(self, sock: socket.socket):
+        if self.gro:
+            try:
+                sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+            except OSError:
+                self.gro = False
+
+    def recv_batch(self, sock: socket.socket) -> List[Tuple[bytes, Tuple[str, int]]]:
+        if not self.gro:
+            return super().recv_batch(sock)
+
+        data, ancdata, _, addr = sock.recvmsg(GRO_BUFFER, socket.CMSG_SPACE(struct.calcsize('i')))
+        size = len(data)
+        for level, kind, value in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO:
+                size = struct.unpack('i', value[:struct.calcsize('i')])[0]
+        if size <= 0 or size >= len(data):
+            return [(data, addr)]
+        return [(data[i:i + size], addr) for i in range(0, len(data), size)]
+
+    def send_batch(self, sock: socket.socket, datagrams: Sequence[bytes], addr) -> int:
+        if not self.gso:
+            return super().send_batch(sock, datagrams, addr)
+
+        start = 0
+        while start < len(datagrams):
+            size = len(datagrams[start])
+            end, total = start + 1, size
+            while (end < len(datagrams) and end - start < GSO_MAX_SEGMENTS
+                   and len(datagrams[end]) <= size and total + len(datagrams[end]) <= MAX_DATAGRAM):
+                total += len(datagrams[end])
+                end += 1
+                if len(datagrams[end - 1]) < size:
+                    break  # only the last datagram of a run may be short
+
+            group = datagrams[start:end]
+            if len(group) == 1:
+                sock.sendto(group[0], addr)
+            else:
+                try:
+                    sock.sendmsg([b''.join(group)], [(SOL_UDP, UDP_SEGMENT, struct.pack('H', size))], 0, addr)
+                except socket.timeout:
+                    raise
+                except OSError:
+                    # e.g. a segment bigger than the route MTU: send these one by one
+                    super().send_batch(sock, group, addr)
+            start = end
+        return len(datagrams)
+
+
+def create_datagram_io(batched: bool = False, offload: bool = False) -> DatagramIO:
+    # offload takes precedence: GRO needs recvmsg's control data, which the
+    # recvmmsg path doesn't collect
+    if offload and (HAVE_GSO or HAVE_GRO):
+        return OffloadDatagramIO()
+    if batched and HAVE_MMSG:
+        return MMsgDatagramIO()
+    return DatagramIO()
@@ -0,0 +1,166 @@
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+from batch_io import DatagramIO, MMsgDatagramIO, OffloadDatagramIO, HAVE_GSO, HAVE_MMSG, SEND_BATCH
+from custom_socket import (BetterUDPSocket, PreparedMessage, Segment, MAX_PAYLOAD_SIZE, MAX_SEGMENT_SIZE,
+                           RECEIVE_BUFFER_SIZE, HEADER_SIZE, TERM, HEADER_STRUCT, CHECKSUM_HEADER_STRUCT,
+                           crc16, internet_checksum)
+
+SEGMENT_COUNT = 10000
+PACKET_COUNT = 200000
+ROOM_SIZE = 50
+BROADCAST_SIZE = 16384
+
+
+class _DictSegment:
+    """The Segment layout before __slots__: a __dict__ each and a copied payload slice."""
+    def __init__(self, flags, src_port, dest_port, seq, ack, data=b''):
+        self.flags = flags
+        self.src_port = src_port
+        self.dest_port = dest_port
+        self.seq = seq
+        self.ack = ack
+        self.data = data[:MAX_PAYLOAD_SIZE]
+        self.checksum = internet_checksum(CHECKSUM_HEADER_STRUCT.pack(flags, src_port, dest_port, seq, ack), self.data)
+        self.crc16 = crc16(self.data)
+    
+    @classmethod
+    def unpack(cls, data):
+        flags, src_port, dest_port, seq, ack, _, _ = HEADER_STRUCT.unpack(data[:HEADER_SIZE])
+        return cls(flags, src_port, dest_port, seq, ack, data[HEADER_SIZE:])
+    
+    @classmethod
+    def prepare(cls, message):
+        # The old _prepare_segments: a slice (copy) per segment, packed afresh on every send
+        segments = []
+        for seq, offset in enumerate(range(0, len(message), MAX_PAYLOAD_SIZE)):
+            last = offset + MAX_PAYLOAD_SIZE >= len(message)
+            segments.append((seq, cls(TERM if last else 0, 1, 2, seq, 0, message[offset:offset + MAX_PAYLOAD_SIZE])))
+        return segments
+
+
+def _traced(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, after - before
+
+
+def bench_segment_memory(count=SEGMENT_COUNT):
+    """Bytes held per in-flight segment, on top of the datagrams/message themselves, vs the old layout."""
+    message = os.urandom(MAX_PAYLOAD_SIZE * count)
+    
+    # Receiver side: segments parked in message_segments until TERM arrives.
+    # The datagrams are what recvfrom() would have allocated anyway.
+    datagrams = [Segment(0, 1, 2, seq, 0, message[seq * MAX_PAYLOAD_SIZE:(seq + 1) * MAX_PAYLOAD_SIZE]).pack()
+                 for seq in range(count)]
+    received, received_bytes = _traced(lambda: [Segment.unpack(d) for d in datagrams])
+    old_received, old_received_bytes = _traced(lambda: [_DictSegment.unpack(d) for d in datagrams])
+    
+    # Sender side: segments sitting in send_buffer after their first transmission
+    sock = BetterUDPSocket()
+    def prepare():
+        segments = sock._prepare_segments(message)
+        for _, segment in segments:
+            segment.pack()
+        return segments
+    sent, sent_bytes = _traced(prepare)
+    old_sent, old_sent_bytes = _traced(lambda: _DictSegment.prepare(message))
+    sock.sock.close()
+    
+    print(f"[BENCH] {count} segments of {MAX_PAYLOAD_SIZE} payload bytes")
+    print(f"[BENCH] received: {received_bytes / count:.1f} bytes/segment "
+          f"(dict layout {old_received_bytes / count:.1f})")
+    print(f"[BENCH] send buffer: {sent_bytes / count:.1f} bytes/segment "
+          f"(dict layout {old_sent_bytes / count:.1f})")
+    return (received_bytes / count, sent_bytes / count), (old_received_bytes / count, old_sent_bytes / count)
+
+
+def _packet_rate(datagram_io, count, size):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.5)
+    datagram_io.configure(receiver)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.settimeout(0.5)
+    addr = receiver.getsockname()
+    
+    received = [0, 0.0]
+    def receive():
+        start = time.perf_counter()
+        while received[0] < count:
+            try:
+                received[0] += len(datagram_io.recv_batch(receiver))
+            except socket.timeout:
+                break
+        received[1] = time.perf_counter() - start
+    receiver_thread = threading.Thread(target=receive)
+    receiver_thread.start()
+    
+    # Whole window bursts, the way the sender hands them over
+    burst = [Segment(0, 1, 2, seq, 0, bytes(size)).pack() for seq in range(SEND_BATCH)]
+    start = time.perf_counter()
+    for _ in range(count // SEND_BATCH):
+        datagram_io.send_batch(sender, burst, addr)
+    send_time = time.perf_counter() - start
+    
+    receiver_thread.join()
+    receiver.close()
+    sender.close()
+    return count / send_time, received[0] / received[1], received[0]
+
+
+def bench_packet_rate(count=PACKET_COUNT, size=MAX_SEGMENT_SIZE - len(Segment(0, 1, 2, 0, 0).pack())):
+    """Loopback datagrams per second, one syscall per datagram vs recvmmsg/sendmmsg vs GSO/GRO."""
+    count -= count % SEND_BATCH
+    paths = [('sendto/recvfrom', DatagramIO())]
+    if HAVE_MMSG:
+        paths.append(('sendmmsg/recvmmsg', MMsgDatagramIO()))
+    else:
+        print("[BENCH] recvmmsg/sendmmsg not available here")
+    if HAVE_GSO:
+        paths.append(('UDP GSO/GRO', OffloadDatagramIO()))
+    else:
+        print("[BENCH] UDP GSO/GRO not available here")
+    
+    results = {}
+    for name, datagram_io in paths:
+        send_rate, receive_rate, received = _packet_rate(datagram_io, count, size)
+        print(f"[BENCH] {name}: send {send_rate:,.0f} pps, receive {receive_rate:,.0f} pps "
+              f"({received}/{count} delivered)")
+        results[name] = (send_rate, receive_rate)
+    return results
+
+
+def bench_broadcast_prepare(recipients=ROOM_SIZE, size=BROADCAST_SIZE):
+    """Segmenting one broadcast for a whole room, per recipient vs from one PreparedMessage."""
+    message = os.urandom(size)
+    sock = BetterUDPSocket()
+    
+    def prepare_all(data):
+        start = time.perf_counter()
+        for _ in range(recipients):
+            sock.send_buffer.clear()
+            for _, segment in sock._prepare_segments(data):
+                segment.pack()
+        return time.perf_counter() - start
+    
+    per_recipient = prepare_all(message)
+    shared = prepare_all(PreparedMessage(message))
+    sock.sock.close()
+    
+    print(f"[BENCH] {size}-byte broadcast to {recipients}: per recipient {per_recipient * 1000:.1f} ms, "
+          f"prepared once {shared * 1000:.1f} ms")
+    return per_recipient, shared
+
+
+if __name__ == "__main__":
+    bench_segment_memory()
+    bench_packet_rate()
+    bench_broadcast_prepare()
@@ -1,12 +1,11 @@
 from custom_socket import BetterUDPSocket
 import threading
 import sys
-import time
 
 
 class Client:
     def __init__(self, HOST, PORT):
-        self.socket = BetterUDPSocket()
+        self.socket = BetterUDPSocket(coalesce=True)
         self.host = HOST
         self.port = PORT
         self.name = ""
@@ -45,6 +44,9 @@ class Client:
                         print(f"\n[{sender[:-1]}] {msg}")
                         print(f"[{self.name}] ", end="", flush=True)  # Restore input prompt
                 else:
+                    # Nothing to read, but the transport is still hearing from the server
+                    if self.socket.peer_alive():
+                        continue
                     if self.running:  # Only print if we're still supposed to be running
                         print("\n[CLIENT] Connection lost or server closed")
                         self.running = False
@@ -80,28 +82,11 @@ class Client:
                 self.running = False
                 break
 
-    def heartbeat(self):
-        while self.running:
-            try:
-                time.sleep(1)  # Send heartbeat every 1 second
-                if self.running:
-                    # Send a simple heartbeat message that won't be broadcast
-                    heartbeat_message = "__HEARTBEAT__"
-                    self.socket.send(heartbeat_message.encode())
-            except Exception as e:
-                if self.running:
-                    print(f"[CLIENT] Error sending heartbeat: {e}")
-                    self.running = False
-                break
-
     def start_chat(self):
         try:
             listen_thread = threading.Thread(target=self.listen_for_messages, daemon=True)
             listen_thread.start()
             
-            heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
-            heartbeat_thread.start()
-            
             self.send_messages()
             
         except Exception as e:
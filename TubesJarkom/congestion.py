@@ -0,0 +1,129 @@
+import time
+from typing import Dict, Optional, Type
+
+# Windows are counted in segments, like WINDOW_SIZE in custom_socket
+INITIAL_WINDOW = 4
+MAX_WINDOW = 256
+MIN_SSTHRESH = 2
+
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+
+class CongestionController:
+    # Interface the Go-Back-N sender drives: read `window` before filling the
+    # pipe, report newly acknowledged segments and losses as they happen.
+    name = None
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW, max_window: int = MAX_WINDOW):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.max_window = max_window
+
+    @property
+    def window(self) -> int:
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        raise NotImplementedError
+
+    def on_loss(self):
+        # Loss detected while ACKs are still flowing (duplicate ACKs)
+        raise NotImplementedError
+
+    def on_timeout(self):
+        # Retransmission timer expired: the pipe has drained, restart from one segment
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+        self.cwnd = 1.0
+
+    def _clamp(self):
+        self.cwnd = min(self.cwnd, float(self.max_window))
+
+
+class RenoController(CongestionController):
+    name = 'reno'
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        if self.cwnd < self.ssthresh:
+            # Slow start: one segment per segment acknowledged
+            self.cwnd += acked
+        else:
+            # Congestion avoidance: about one segment per round trip
+            self.cwnd += acked / self.cwnd
+        self._clamp()
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+        self.cwnd = self.ssthresh
+
+
+class CubicController(CongestionController):
+    # RFC 8312: after a loss the window follows a cubic curve back towards
+    # the size it had when the loss happened, flat near it and steep away from it
+    name = 'cubic'
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW, max_window: int = MAX_WINDOW):
+        super().__init__(initial_window, max_window)
+        self.w_max = 0.0
+        self.k = 0.0
+        self.epoch_start: Optional[float] = None
+
+    def on_ack(self, acked: int, rtt: Optional[float]):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+            self._clamp()
+            return
+
+        rtt = rtt or 0.1
+        now = time.monotonic()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / CUBIC_C) ** (1 / 3)
+            else:
+                self.k = 0.0
+                self.w_max = self.cwnd
+
+        t = now - self.epoch_start
+        target = CUBIC_C * (t + rtt - self.k) ** 3 + self.w_max
+        # Never grow slower than Reno would on the same path
+        reno_estimate = self.w_max * CUBIC_BETA + 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * (t / rtt)
+        target = max(target, reno_estimate)
+
+        if target > self.cwnd:
+            self.cwnd += acked * (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += acked * 0.01 / self.cwnd
+        self._clamp()
+
+    def on_loss(self):
+        self._reduce()
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+        self._reduce()
+        self.cwnd = 1.0
+
+    def _reduce(self):
+        # Fast convergence: give up bandwidth sooner if the last peak was higher
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, MIN_SSTHRESH)
+        self.epoch_start = None
+
+
+CONGESTION_CONTROLLERS: Dict[str, Type[CongestionController]] = {
+    RenoController.name: RenoController,
+    CubicController.name: CubicController,
+}
+
+
+def create_controller(name: str, initial_window: int = INITIAL_WINDOW,
+                      max_window: int = MAX_WINDOW) -> CongestionController:
+    try:
+        controller_class = CONGESTION_CONTROLLERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown congestion control algorithm '{name}'") from None
+    return controller_class(initial_window, max_window)
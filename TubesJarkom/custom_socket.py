@@ -1,69 +1,323 @@
+import errno
+import hashlib
+import os
 import socket
 import struct
+import sys
 import time
 import threading
+from collections import deque
+from concurrent.futures import Future
 from queue import Queue, Empty
 from typing import List, Optional, Dict, Tuple
 import random
+from array import array
+
+from batch_io import DatagramIO, create_datagram_io
+from congestion import create_controller
+from timer_wheel import TimerWheel
 
 SYN = 0b0001
 ACK = 0b0010
 FIN = 0b0100
 TERM = 0b1000
+PROBE = 0b10000
+SACK = 0b100000
+KEEPALIVE = 0b1000000  # flag-only segment from an idle connection
+COALESCED = 0b10000000  # on a message's last segment: it holds several length-prefixed messages
 TIMEOUT = 0.5
+FIN_INTERVAL = 0.1  # gap between FIN retransmissions, RETRIES of them in all
 RETRIES = 20
-WINDOW_SIZE = 4
-MAX_SEGMENT_SIZE = 128
+WINDOW_SIZE = 4  # initial congestion window, in segments
+MAX_WINDOW_SIZE = 256
+DUP_ACK_THRESHOLD = 3
+DELAYED_ACK_SEGMENTS = 2  # ACK at least every this many in-order segments
+DELAYED_ACK_TIMEOUT = 0.02  # must stay well below MIN_RTO
+CONGESTION_CONTROL = 'reno'
+MAX_SEGMENT_SIZE = 128  # floor every peer speaks; larger sizes are negotiated
+MAX_SEGMENT_SIZE_LIMIT = 65507  # largest UDP payload over IPv4
 HEADER_SIZE = 17  # 1+2+2+4+4+2+2 bytes
+CHECKSUM_OFFSET = 13  # checksum covers the header up to here, then the payload
 MAX_PAYLOAD_SIZE = MAX_SEGMENT_SIZE - HEADER_SIZE  # 111 bytes
-SEGMENT_TIMEOUT = 0.5
+MAX_PAYLOAD_LIMIT = MAX_SEGMENT_SIZE_LIMIT - HEADER_SIZE
+SEGMENT_TIMEOUT = 0.5  # initial RTO, before any round trip has been measured
+MIN_RTO = 0.05
+MAX_RTO = 10.0
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+RECEIVE_BUFFER_SIZE = 1 << 20
+
+# Path MTU probing: candidate segment sizes, tried smallest first
+PROBE_SIZES = (548, 1200, 1400, 1472, 8972, 16384, MAX_SEGMENT_SIZE_LIMIT)
+PROBE_ATTEMPTS = 2
+IP_UDP_OVERHEAD = 28
+FRAGMENT_SAFE_MSS = 1400  # the ceiling when DF can't be set and probes could get through as fragments
+
+# Linux socket options; the socket module doesn't export these
+IP_MTU_DISCOVER = 10
+IP_PMTUDISC_WANT = 1
+IP_PMTUDISC_DO = 2
+IP_MTU = 14
+
+# Handshake options carried in the SYN / SYN-ACK payload as kind, length, value
+OPT_MSS = 2
+OPT_SACK_PERMITTED = 4  # no value; only offered together with Selective Repeat
+OPT_SELECTIVE_REPEAT = 32  # no value; present when the sender supports it
+OPT_COALESCE = 33  # no value; the sender can split COALESCED messages
+
+# SACK ACKs carry up to this many (start, end) ranges the receiver holds past Rn
+MAX_SACK_BLOCKS = 4
+
+# Keepalives: a connection that has sent nothing for KEEPALIVE_INTERVAL sends
+# a KEEPALIVE; a peer silent for KEEPALIVE_TIMEOUT is presumed gone
+KEEPALIVE_INTERVAL = 5.0
+KEEPALIVE_TIMEOUT = 30.0
+
+# Small-message coalescing (Nagle-style): while earlier data is unACKed,
+# messages up to COALESCE_MAX_MESSAGE bytes wait up to COALESCE_DELAY to be
+# packed into one segment with the ones sent after them
+COALESCE_DELAY = 0.005
+COALESCE_MAX_MESSAGE = 1024
+
+# Server handshakes: at most MAX_HALF_OPEN waiting for a final ACK, each
+# SYN-ACK sent SYNACK_RETRIES times with the interval doubling from TIMEOUT * 2.
+# Past the cap the server answers with SYN cookies and keeps no state.
+MAX_HALF_OPEN = 128
+SYNACK_RETRIES = 6
+COOKIE_PERIOD = 64  # seconds per cookie counter tick; a cookie is good for two ticks
+COOKIE_MSS_SIZES = (128, 536, 1200, 1400, 1472, 8972, 16384, MAX_SEGMENT_SIZE_LIMIT)
 CRC16_POLYNOMIAL = 0xA001  # CRC-16-CCITT polynomial
 
+def _build_crc16_table(polynomial: int) -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ polynomial
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+# Slicing-by-2: CRC16_TABLE advances the register by one byte, CRC16_TABLE_2
+# by two, so the engine below consumes a full 16-bit word per lookup pair.
+CRC16_TABLE = _build_crc16_table(CRC16_POLYNOMIAL)
+CRC16_TABLE_2 = [(CRC16_TABLE[i] >> 8) ^ CRC16_TABLE[CRC16_TABLE[i] & 0xFF] for i in range(256)]
+
+def crc16(data: bytes, crc: int = 0xFFFF) -> int:
+    # binascii.crc_hqx uses 0x1021, not this polynomial, so there is no
+    # stdlib shortcut; this gives the same values as the bitwise loop.
+    length = len(data)
+    words = array('H')
+    words.frombytes(data[:length & ~1])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    
+    table, table_2 = CRC16_TABLE, CRC16_TABLE_2
+    for word in words:
+        x = crc ^ word
+        crc = table_2[x & 0xFF] ^ table[x >> 8]
+    
+    if length & 1:
+        crc = (crc >> 8) ^ table[(crc ^ data[length - 1]) & 0xFF]
+    return crc & 0xFFFF
+
+def internet_checksum(*chunks) -> int:
+    # Read as one big-endian integer, 2**16 == 1 (mod 0xFFFF), so the residue
+    # of the whole buffer equals the end-around-carry sum of its 16-bit words.
+    # Chunks are folded in without being concatenated first.
+    total = 0
+    length = 0
+    nonzero = False
+    for chunk in chunks:
+        value = int.from_bytes(chunk, 'big')
+        total = (total * (256 if len(chunk) & 1 else 1) + value) % 0xFFFF
+        length += len(chunk)
+        nonzero = nonzero or value != 0
+    
+    if length & 1:
+        total = (total * 256) % 0xFFFF
+    if total == 0 and nonzero:
+        total = 0xFFFF
+    return ~total & 0xFFFF
+
+def payload_sum(data) -> Tuple[int, int, bool]:
+    # The payload's part of internet_checksum(header, data), kept apart so it
+    # can be reused under any header: residue, length, any nonzero bytes
+    value = int.from_bytes(data, 'big')
+    return value % 0xFFFF, len(data), value != 0
+
+def checksum_with_payload(header: bytes, payload: Tuple[int, int, bool]) -> int:
+    # Same result as internet_checksum(header, data) for payload == payload_sum(data)
+    residue, length, nonzero = payload
+    value = int.from_bytes(header, 'big')
+    total = (value * (256 if length & 1 else 1) + residue) % 0xFFFF
+    if (len(header) + length) & 1:
+        total = (total * 256) % 0xFFFF
+    if total == 0 and (nonzero or value != 0):
+        total = 0xFFFF
+    return ~total & 0xFFFF
+
+HEADER_STRUCT = struct.Struct('!BHHIIHH')
+CHECKSUM_HEADER_STRUCT = struct.Struct('!BHHII')
+OPTION_STRUCT = struct.Struct('!BB')
+MSS_STRUCT = struct.Struct('!H')
+SACK_BLOCK_STRUCT = struct.Struct('!II')
+COALESCE_LENGTH_STRUCT = struct.Struct('!H')
+
+def encode_options(options: Dict[int, bytes]) -> bytes:
+    return b''.join(OPTION_STRUCT.pack(kind, len(value)) + value for kind, value in options.items())
+
+def decode_options(data) -> Dict[int, bytes]:
+    options = {}
+    offset = 0
+    while offset + OPTION_STRUCT.size <= len(data):
+        kind, length = OPTION_STRUCT.unpack_from(data, offset)
+        offset += OPTION_STRUCT.size
+        options[kind] = bytes(data[offset:offset + length])
+        offset += length
+    return options
+
+def encode_sack_blocks(blocks: List[Tuple[int, int]]) -> bytes:
+    return b''.join(SACK_BLOCK_STRUCT.pack(start, end) for start, end in blocks[:MAX_SACK_BLOCKS])
+
+def decode_sack_blocks(data) -> List[Tuple[int, int]]:
+    count = min(len(data) // SACK_BLOCK_STRUCT.size, MAX_SACK_BLOCKS)
+    return [SACK_BLOCK_STRUCT.unpack_from(data, i * SACK_BLOCK_STRUCT.size) for i in range(count)]
+
+def encode_coalesced(messages: List[bytes]) -> bytes:
+    return b''.join(COALESCE_LENGTH_STRUCT.pack(len(message)) + message for message in messages)
+
+def decode_coalesced(data) -> List[bytes]:
+    messages = []
+    offset = 0
+    while offset + COALESCE_LENGTH_STRUCT.size <= len(data):
+        length, = COALESCE_LENGTH_STRUCT.unpack_from(data, offset)
+        offset += COALESCE_LENGTH_STRUCT.size
+        if offset + length > len(data):
+            raise ValueError("Truncated coalesced message")
+        messages.append(bytes(data[offset:offset + length]))
+        offset += length
+    return messages
+
+def _sack_ranges(buffered, latest_seq) -> List[Tuple[int, int]]:
+    # Contiguous runs of buffered segments as [start, end) ranges, the one
+    # holding the segment just received first (RFC 2018), then highest first
+    blocks = []
+    for seq in sorted(buffered):
+        if blocks and blocks[-1][1] == seq:
+            blocks[-1][1] = seq + 1
+        else:
+            blocks.append([seq, seq + 1])
+    
+    blocks.sort(key=lambda block: (not block[0] <= latest_seq < block[1], -block[0]))
+    return [(start, end) for start, end in blocks]
+
+def _cookie_hash(secret: bytes, addr, client_seq: int, counter: int, fields: int) -> int:
+    message = f"{addr[0]}|{addr[1]}|{client_seq}|{counter}|{fields}".encode()
+    return int.from_bytes(hashlib.blake2s(message, key=secret, digest_size=4).digest(), 'big') & 0x1FFFFF
+
+def _syn_cookie(secret: bytes, addr, client_seq: int, mss: int, selective_repeat: bool, sack: bool) -> int:
+    # 31-bit server ISN, so the client's ACK of it (+1) still fits the seq field:
+    # 5-bit time counter | 3-bit MSS index | SR bit | SACK bit | 21-bit keyed hash
+    counter = int(time.time() // COOKIE_PERIOD)
+    mss_index = max(i for i, size in enumerate(COOKIE_MSS_SIZES) if size <= mss)
+    fields = mss_index << 2 | selective_repeat << 1 | sack
+    return (counter & 0x1F) << 26 | fields << 21 | _cookie_hash(secret, addr, client_seq, counter, fields)
+
+def _check_syn_cookie(secret: bytes, addr, client_seq: int, cookie: int) -> Optional[Tuple[int, bool, bool]]:
+    # (mss, selective_repeat, sack) the cookie was issued with, or None if forged or stale
+    fields = cookie >> 21 & 0x1F
+    now = int(time.time() // COOKIE_PERIOD)
+    for counter in (now, now - 1):
+        if (counter & 0x1F) == cookie >> 26 and _cookie_hash(secret, addr, client_seq, counter, fields) == cookie & 0x1FFFFF:
+            return COOKIE_MSS_SIZES[fields >> 2], bool(fields & 2), bool(fields & 1)
+    return None
+
+def _negotiate_mss(local_mss: int, options: Dict[int, bytes]) -> int:
+    # A peer that sends no MSS option predates negotiation and only speaks the default
+    if len(options.get(OPT_MSS, b'')) != MSS_STRUCT.size:
+        return MAX_SEGMENT_SIZE
+    peer_mss, = MSS_STRUCT.unpack(options[OPT_MSS])
+    return max(MAX_SEGMENT_SIZE, min(local_mss, peer_mss, MAX_SEGMENT_SIZE_LIMIT))
+
+def _set_dont_fragment(sock, enabled: bool) -> bool:
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO if enabled else IP_PMTUDISC_WANT)
+        return True
+    except OSError:
+        return False
+
+def _path_mtu_hint(addr) -> Optional[int]:
+    # The kernel's route MTU towards addr; only a connected socket can report it
+    if not sys.platform.startswith('linux'):
+        return None
+    probe_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe_sock.connect(addr)
+        return probe_sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        probe_sock.close()
+
 class Segment:
-    def __init__(self, flags: int, src_port: int, dest_port: int, seq: int, ack: int, data: bytes = b''):
+    # Thousands of these sit in send buffers and reassembly dicts, so no __dict__.
+    # Once a segment has a wire form (encoded or received) the payload lives
+    # only inside that buffer and `data` is a memoryview onto it; bytes are
+    # copied when a message is assembled, not per segment.
+    __slots__ = ('flags', 'src_port', 'dest_port', 'seq', 'ack', 'checksum', 'crc16', '_payload', '_wire')
+    
+    def __init__(self, flags: int, src_port: int, dest_port: int, seq: int, ack: int, data: bytes = b'',
+                 prepared: Optional[Tuple[Tuple[int, int, bool], int]] = None):
         self.flags = flags
         self.src_port = src_port
         self.dest_port = dest_port
         self.seq = seq
         self.ack = ack
-        self.data = data[:MAX_PAYLOAD_SIZE]
-        self.checksum = self._calculate_checksum()
-        self.crc16 = self._calculate_crc16()
+        self._payload = data if len(data) <= MAX_PAYLOAD_LIMIT else data[:MAX_PAYLOAD_LIMIT]
+        self._wire = None
+        if prepared is None:
+            self.checksum = self._calculate_checksum()
+            self.crc16 = self._calculate_crc16()
+        else:
+            # (payload_sum, crc16) worked out once for every recipient of a
+            # PreparedMessage; only the header is summed here
+            payload, self.crc16 = prepared
+            header = CHECKSUM_HEADER_STRUCT.pack(flags, src_port, dest_port, seq, ack)
+            self.checksum = checksum_with_payload(header, payload)
+    
+    @property
+    def data(self):
+        if self._payload is None:
+            return memoryview(self._wire)[HEADER_SIZE:]
+        return self._payload
     
     def _calculate_checksum(self) -> int:
-        header = struct.pack('!BHHII', self.flags, self.src_port, self.dest_port, self.seq, self.ack)
-        packet_data = header + self.data
-        
-        if len(packet_data) % 2 == 1:
-            packet_data += b'\x00'
-        
-        checksum = 0
-        for i in range(0, len(packet_data), 2):
-            word = (packet_data[i] << 8) + packet_data[i + 1]
-            checksum += word
-            checksum = (checksum & 0xFFFF) + (checksum >> 16)
-        
-        return ~checksum & 0xFFFF
+        header = CHECKSUM_HEADER_STRUCT.pack(self.flags, self.src_port, self.dest_port, self.seq, self.ack)
+        return internet_checksum(header, self.data)
     
     def _calculate_crc16(self) -> int:
-        crc = 0xFFFF
-        for byte in self.data:
-            crc ^= byte
-            for _ in range(8):
-                if crc & 0x0001:
-                    crc = (crc >> 1) ^ CRC16_POLYNOMIAL
-                else:
-                    crc >>= 1
-        return crc & 0xFFFF
+        return crc16(self.data)
     
     def pack(self) -> bytes:
-        header = struct.pack('!BHHIIHH', self.flags, self.src_port, self.dest_port, 
-                           self.seq, self.ack, self.checksum, self.crc16)
-        segment = header + self.data
+        # Encoded once; retransmits reuse the same buffer
+        if self._wire is not None:
+            return self._wire
+        
+        header = HEADER_STRUCT.pack(self.flags, self.src_port, self.dest_port, 
+                                    self.seq, self.ack, self.checksum, self.crc16)
+        segment = header + self._payload
         
-        if len(segment) > MAX_SEGMENT_SIZE:
-            raise ValueError(f"Segment size {len(segment)} exceeds maximum {MAX_SEGMENT_SIZE}")
+        if len(segment) > MAX_SEGMENT_SIZE_LIMIT:
+            raise ValueError(f"Segment size {len(segment)} exceeds maximum {MAX_SEGMENT_SIZE_LIMIT}")
         
+        self._wire = segment
+        self._payload = None
         return segment
     
     @classmethod
@@ -71,242 +325,1058 @@ class Segment:
         if len(data) < HEADER_SIZE:
             raise ValueError("Packet too short")
         
-        if len(data) > MAX_SEGMENT_SIZE:
-            raise ValueError(f"Segment size {len(data)} exceeds maximum {MAX_SEGMENT_SIZE}")
+        if len(data) > MAX_SEGMENT_SIZE_LIMIT:
+            raise ValueError(f"Segment size {len(data)} exceeds maximum {MAX_SEGMENT_SIZE_LIMIT}")
         
-        header = data[:HEADER_SIZE]
-        payload = data[HEADER_SIZE:]
-        flags, src_port, dest_port, seq, ack, checksum, crc16 = struct.unpack('!BHHIIHH', header)
+        flags, src_port, dest_port, seq, ack, checksum, crc = HEADER_STRUCT.unpack_from(data)
+        view = memoryview(data)
+        payload = view[HEADER_SIZE:]
         
-        segment = cls(flags, src_port, dest_port, seq, ack, payload)
-        if segment.checksum != checksum:
+        # Verify straight off the received buffer instead of re-encoding it
+        if internet_checksum(view[:CHECKSUM_OFFSET], payload) != checksum:
             raise ValueError("Checksum mismatch")
         
-        if segment.crc16 != crc16:
+        if crc16(payload) != crc:
             raise ValueError("CRC16 mismatch")
         
+        segment = cls.__new__(cls)
+        segment.flags = flags
+        segment.src_port = src_port
+        segment.dest_port = dest_port
+        segment.seq = seq
+        segment.ack = ack
+        segment.checksum = checksum
+        segment.crc16 = crc
+        segment._payload = None
+        segment._wire = data
         return segment
     
     def is_termination(self) -> bool:
         return bool(self.flags & TERM)
     
     def set_termination(self):
+        self._payload = self.data
+        self._wire = None
         self.flags |= TERM
         self.checksum = self._calculate_checksum()
 
-class BetterUDPClientSocket:    
-    def __init__(self, server_sock, client_addr, server_port, client_port, seq_num, ack_num):
-        self.server_sock = server_sock
-        self.addr = client_addr
-        self.server_port = server_port
-        self.client_port = client_port
-        self.seq_num = seq_num
-        self.ack_num = ack_num
-        self.connected = True
-        
-        # Go-Back-N variables
+class PreparedMessage:
+    # A message sent unchanged to many connections (a chat broadcast): the
+    # payload is cut into chunks, and their CRC16s and checksum sums computed,
+    # once per segment size instead of once per recipient. send() accepts it
+    # wherever it accepts bytes.
+    __slots__ = ('data', '_chunks')
+    
+    def __init__(self, data: bytes):
+        self.data = data
+        self._chunks: Dict[int, list] = {}
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def chunks(self, payload_size: int) -> List[Tuple[memoryview, Tuple[int, int, bool], int]]:
+        # Recipients usually share a few segment sizes; a race here only computes twice
+        chunks = self._chunks.get(payload_size)
+        if chunks is None:
+            view = memoryview(self.data)
+            chunks = []
+            for offset in range(0, len(self.data), payload_size):
+                chunk = view[offset:offset + payload_size]
+                chunks.append((chunk, payload_sum(chunk), crc16(chunk)))
+            self._chunks[payload_size] = chunks
+        return chunks
+
+class RttEstimator:
+    # RFC 6298 smoothed round-trip time. Karn's rule is the caller's job:
+    # never sample a segment that has been retransmitted.
+    def __init__(self, initial_rto: float = SEGMENT_TIMEOUT):
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.initial_rto = initial_rto
+        self.rto = initial_rto
+    
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.reset_backoff()
+    
+    def back_off(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
+    
+    def reset_backoff(self):
+        # Called on forward progress too: after a timeout every ACK may be for a
+        # retransmission, and Karn's rule alone would leave the RTO inflated
+        if self.srtt is None:
+            self.rto = self.initial_rto
+        else:
+            self.rto = min(max(self.srtt + RTT_K * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+class _HalfOpen:
+    # Server side of a handshake waiting for the client's final ACK
+    __slots__ = ('synack', 'server_seq', 'client_seq', 'client_port', 'negotiated_mss', 'selective_repeat',
+                 'sack', 'coalesce', 'first_sent', 'attempts', 'timer')
+
+def _settle(future, result=None, error=None):
+    # The owner may have cancelled it; leave those alone
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class _ReliableConnection:
+    # The protocol for one connection, with no I/O or threads of its own:
+    # Go-Back-N, or Selective Repeat (and SACK) when both ends offered it in
+    # the handshake, congestion control, delayed ACKs, coalescing and
+    # keepalives. Messages are numbered as they're queued and stream through
+    # a single window, which ACKs and timers move along. The thread-based
+    # sockets below and the asyncio ones in async_socket drive the same code.
+    #
+    # Events come in through _send_message(), handle_segment() and the timers
+    # it sets, and calls must never overlap. Transports provide
+    # _make_segment() with their ports, _transmit() (and _transmit_batch()
+    # to send a window burst at once), _call_later(delay, callback, *args)
+    # returning a handle with cancel(), _new_future(), and a message_queue
+    # with put_nowait().
+    log_tag = 'CLIENT_SOCK'
+    
+    def _init_transfer_state(self, seq_num, ack_num):
+        # Sender: Sb..end_seq is every segment queued and not yet ACKed, and
+        # next_to_send runs ahead of Sb as far as the congestion window allows
+        self.congestion = create_controller(self.congestion_control, WINDOW_SIZE, MAX_WINDOW_SIZE)
         self.Sb = seq_num
-        self.Sm = self.Sb + WINDOW_SIZE - 1
-        self.next_to_send = self.Sb
+        self.next_to_send = seq_num
+        self.end_seq = seq_num
+        self.send_buffer = {}
+        self.sent_at = {}  # seq -> when its latest copy went out
+        self.retransmit_timers = {}
+        self.expired = set()  # Go-Back-N: timed out before becoming the oldest segment
+        self.retransmitted = set()
+        self.recovery_point = seq_num  # losses below this were already reacted to
+        self.dup_acks = 0
+        
+        # Retransmission timeout, driven by measured round trips
+        self.rtt = RttEstimator()
+        
+        # Each future completes once the cumulative ACK passes its message's last segment
+        self.pending_sends = deque()  # (end_seq, future), in send order
+        
+        # Receiver; out_of_order holds segments past a gap (Selective Repeat only)
         self.Rn = ack_num
+        self.message_segments = []
+        self.out_of_order = {}
         
-        # Buffers and synchronization
-        self.send_buffer = {}
-        self.ack_received = threading.Event()
-        self.latest_ack = self.Sb
-        self.ack_lock = threading.Lock()
+        # Delayed ACKs: in-order segments received since the last ACK went out
+        self.unacked_segments = 0
+        self.last_received_seq = 0
+        self.delayed_ack_timer = None
         
-        # Message handling
-        self.message_queue = Queue()
-        self.message_segments = {}
-        self.receive_lock = threading.Lock()
+        # Small messages waiting to share a segment (when coalescing was negotiated)
+        self.coalesce_buffer = []  # (data, future)
+        self.coalesce_size = 0
+        self.coalesce_timer = None
+        
+        # Liveness: any segment counts, so keepalives only fill silences
+        self.last_sent = time.time()
+        self.last_heard = self.last_sent
+        self.keepalive_timer = None
+        
+        # Until the peer is heard from, the final handshake ACK may have been
+        # lost; our segments repeat it (ACK flag and field) so a server
+        # answering with SYN cookies can still complete the handshake
+        self.peer_confirmed = True
         
-        # Control flags
-        self.sending_complete = False
-        self.send_lock = threading.Lock()
+        # Handshake RTT for a path MTU probe to run again once the peer is heard from
+        self.probe_retry_rtt: Optional[float] = None
         
+        self.stats = {'segments_sent': 0, 'segments_retransmitted': 0, 'fast_retransmits': 0,
+                      'acks_sent': 0, 'acks_saved': 0}
     
-    def send(self, data: bytes):
-        if not self.connected:
-            raise RuntimeError("Not connected")
-        return self._send_go_back_n_pipelined(data)
+    def _make_segment(self, flags, seq, ack, data=b'', prepared=None) -> Segment:
+        raise NotImplementedError
     
-    def receive(self) -> Optional[bytes]:
+    def _transmit(self, segment: Segment):
+        raise NotImplementedError
+    
+    def _transmit_batch(self, segments: List[Segment]):
+        for segment in segments:
+            self._transmit(segment)
+    
+    def _call_later(self, delay: float, callback, *args):
+        raise NotImplementedError
+    
+    def _new_future(self):
+        raise NotImplementedError
+    
+    def _complete(self, future, result=None, error=None):
+        _settle(future, result, error)
+    
+    def _closed(self):
+        # The connection has just closed
+        pass
+    
+    def _fin_acked(self):
+        # Our own FIN got through; stop retransmitting it
+        pass
+    
+    def _probe_acked(self, size: int):
+        # A path MTU probe this large got through
+        pass
+    
+    def _retry_probe(self, rtt: float):
+        # Probe the path again, without blocking the caller
+        pass
+    
+    def _send_message(self, data):
+        # Queues the message and returns at once; the future's result is True
+        # when it has been ACKed (False for an empty message), or it fails
+        # with ConnectionError if the connection closes first
         if not self.connected:
             raise RuntimeError("Not connected")
         
-        try:
-            message = self.message_queue.get(timeout=10.0)
-            print(f"[CLIENT_SOCK {self.addr}] Received message ({len(message)} bytes)")
-            return message
-        except Empty:
-            return None
+        if self.coalesce and 0 < len(data) <= self._coalesce_limit():
+            return self._coalesce_message(data)
+        
+        # Anything already waiting to be coalesced was sent first
+        self._flush_coalesced()
+        future = self._new_future()
+        self._queue_message(data, [future])
+        return future
     
-    def close(self):
+    def _queue_message(self, data, futures, last_flags=0):
         if not self.connected:
+            for future in futures:
+                self._complete(future, error=ConnectionError("Connection closed"))
             return
         
-        print(f"[CLIENT_SOCK {self.addr}] Closing connection")
-        fin_segment = Segment(FIN, self.server_port, self.client_port, self.seq_num, 0)
+        segments = self._prepare_segments(data, last_flags)
+        if not segments:
+            for future in futures:
+                self._complete(future, False)
+            return
         
-        for attempt in range(RETRIES):
-            self.server_sock.sendto(fin_segment.pack(), self.addr)
-            print(f"[CLIENT_SOCK {self.addr}] Sent FIN")
-            time.sleep(0.1)
+        self.end_seq = segments[-1][0] + 1
+        for future in futures:
+            self.pending_sends.append((self.end_seq, future))
+        self._fill_window()
+    
+    def _coalesce_limit(self):
+        return min(COALESCE_MAX_MESSAGE, self.mss - HEADER_SIZE - COALESCE_LENGTH_STRUCT.size)
+    
+    def _coalesce_message(self, data):
+        # A PreparedMessage is kept whole, so a flush holding only it still
+        # sends the chunks and checksums computed once for every recipient
+        if not isinstance(data, PreparedMessage):
+            data = bytes(data)
+        future = self._new_future()
+        framed_size = COALESCE_LENGTH_STRUCT.size + len(data)
         
-        self.connected = False
+        if self.coalesce_size + framed_size > self.mss - HEADER_SIZE:
+            self._flush_coalesced()
+        
+        # Nagle: with nothing in flight there's nothing to wait for
+        idle = not self.coalesce_buffer and self.Sb >= self.end_seq
+        self.coalesce_buffer.append((data, future))
+        self.coalesce_size += framed_size
+        
+        if idle or self.coalesce_size >= self.mss - HEADER_SIZE:
+            self._flush_coalesced()
+        elif self.coalesce_timer is None:
+            self.coalesce_timer = self._call_later(self.coalesce_delay, self._coalesce_expired)
+        return future
     
-    def _send_go_back_n_pipelined(self, data: bytes):
+    def _coalesce_expired(self):
+        self.coalesce_timer = None
+        self._flush_coalesced()
+    
+    def _flush_coalesced(self):
+        if self.coalesce_timer is not None:
+            self.coalesce_timer.cancel()
+            self.coalesce_timer = None
+        if not self.coalesce_buffer:
+            return
         
-        segments = self._prepare_segments(data)
-        if not segments:
-            return False
+        batch = self.coalesce_buffer
+        self.coalesce_buffer = []
+        self.coalesce_size = 0
         
-        base_seq = self.next_to_send
-        total_segments = len(segments)
+        # A lone message goes out as it is; either way each message's future
+        # completes with the segments carrying it
+        futures = [future for _, future in batch]
+        if len(batch) == 1:
+            self._queue_message(batch[0][0], futures)
+        else:
+            messages = [data.data if isinstance(data, PreparedMessage) else data for data, _ in batch]
+            self._queue_message(encode_coalesced(messages), futures, COALESCED)
+    
+    def idle_time(self) -> float:
+        # Seconds since anything at all arrived from the peer
+        return time.time() - self.last_heard
+    
+    def peer_alive(self, timeout: float = KEEPALIVE_TIMEOUT) -> bool:
+        return self.connected and self.idle_time() < timeout
+    
+    def _start_keepalive(self):
+        self.keepalive_timer = self._call_later(KEEPALIVE_INTERVAL, self._keepalive_expired)
+    
+    def _keepalive_expired(self):
+        # Re-armed for when the connection could next have been idle long enough
+        if not self.connected:
+            return
         
-        with self.send_lock:
-            self.Sb = base_seq
-            self.next_to_send = base_seq
-            self.latest_ack = base_seq
-            self.sending_complete = False
+        idle = time.time() - self.last_sent
+        if idle >= KEEPALIVE_INTERVAL:
+            flags = KEEPALIVE if self.peer_confirmed else KEEPALIVE | ACK
+            self._transmit(self._make_segment(flags, self.end_seq, self.Rn))
+            self.last_sent = time.time()
+            idle = 0
+        self.keepalive_timer = self._call_later(KEEPALIVE_INTERVAL - idle, self._keepalive_expired)
+    
+    def _connection_closed(self) -> bool:
+        # Stops every timer and fails whatever is still queued; False if it
+        # had already closed
+        if not self.connected:
+            return False
         
-        segment_timestamps = {}
+        self.connected = False
+        for timer in self.retransmit_timers.values():
+            timer.cancel()
+        self.retransmit_timers.clear()
+        for timer in (self.delayed_ack_timer, self.coalesce_timer, self.keepalive_timer):
+            if timer is not None:
+                timer.cancel()
+        self.delayed_ack_timer = self.coalesce_timer = self.keepalive_timer = None
         
-        while self.Sb < base_seq + total_segments:
-            while (self.next_to_send < self.Sb + WINDOW_SIZE and 
-                   self.next_to_send < base_seq + total_segments):
-                
-                seq = self.next_to_send
-                if seq in self.send_buffer:
-                    segment = self.send_buffer[seq]
-                    self.server_sock.sendto(segment.pack(), self.addr)
-                    segment_timestamps[seq] = time.time()
-                    
-                    with self.send_lock:
-                        self.next_to_send += 1
-            
-            self._check_and_slide_window()
-            
-            # Check for timeouts
-            current_time = time.time()
-            for seq in range(self.Sb, min(self.Sb + WINDOW_SIZE, self.next_to_send)):
-                if seq in segment_timestamps:
-                    if current_time - segment_timestamps[seq] > SEGMENT_TIMEOUT:
-                        self._retransmit_window(segment_timestamps)
-                        break
-            
-            time.sleep(0.001)
+        error = ConnectionError("Connection closed")
+        for _, future in self.coalesce_buffer:
+            self._complete(future, error=error)
+        for _, future in self.pending_sends:
+            self._complete(future, error=error)
+        self.coalesce_buffer = []
+        self.coalesce_size = 0
+        self.pending_sends.clear()
         
-        print(f"[CLIENT_SOCK {self.addr}] Send complete")
+        self._closed()
         return True
     
-    def _prepare_segments(self, data: bytes):
+    def _fin_segment(self) -> Optional[Segment]:
+        # Our FIN, None once closed. Segments held back for a delayed ACK
+        # are ACKed first, or the peer would see the FIN before that ACK and
+        # fail a send we did receive; the FIN repeats the ACK as well
+        if not self.connected:
+            return None
+        if self.unacked_segments:
+            self._flush_ack()
+        return self._make_segment(FIN, self.end_seq, self.Rn)
+    
+    def handle_segment(self, segment: Segment):
+        self.last_heard = time.time()
+        if not self.peer_confirmed:
+            self.peer_confirmed = True
+            if self.probe_retry_rtt is not None:
+                rtt, self.probe_retry_rtt = self.probe_retry_rtt, None
+                self._retry_probe(rtt)
+        if segment.flags & KEEPALIVE:
+            return
+        
+        # FINs carry neither data nor an ACK, and still count after closing
+        if segment.flags & FIN:
+            self._handle_fin_segment(segment)
+            return
+        if not self.connected:
+            return
+        
+        # Path MTU probes are padding only; never treat them as data or ACKs
+        if segment.flags & PROBE:
+            self._handle_probe_segment(segment)
+            return
+        
+        if (segment.flags & ACK) and not (segment.flags & SYN) and segment.ack > 0:
+            self._handle_ack_segment(segment)
+        
+        if len(segment.data) > 0 and not (segment.flags & (SYN | SACK)):
+            self._handle_data_segment(segment)
+    
+    def _handle_fin_segment(self, segment):
+        if segment.flags & ACK:
+            self._fin_acked()
+            return
+        
+        # A FIN repeats its sender's cumulative ACK, as the last ACKs sent
+        # before it can arrive after it; what they cover was delivered
+        if self.connected and segment.ack > self.Sb:
+            self._handle_ack_segment(segment)
+        
+        print(f"[{self.log_tag} {self.addr}] Received FIN")
+        self._transmit(self._make_segment(FIN | ACK, self.end_seq, segment.seq + 1))
+        self._connection_closed()
+    
+    def _handle_probe_segment(self, segment):
+        if segment.flags & ACK:
+            self._probe_acked(segment.ack)
+            return
+        
+        # The probe made it across the path, so segments this large are safe to send back
+        size = HEADER_SIZE + len(segment.data)
+        self.mss = max(self.mss, min(size, self.negotiated_mss))
+        self._transmit(self._make_segment(PROBE | ACK, 0, size))
+    
+    def _probe_plan(self, rtt, dont_fragment=True) -> Tuple[float, List[int]]:
+        # Probe timeout, and the sizes to climb with DF set until a probe goes
+        # unanswered; the peer raises its own segment size as they reach it
+        timeout = min(max(rtt * 4, 0.05), TIMEOUT)
+        sizes = sorted({min(size, self.negotiated_mss) for size in PROBE_SIZES})
+        
+        mtu_hint = _path_mtu_hint(self.addr)
+        if mtu_hint:
+            limit = min(mtu_hint - IP_UDP_OVERHEAD, self.negotiated_mss)
+            sizes = sorted({size for size in sizes if size < limit} | {limit})
+        if not dont_fragment:
+            sizes = [size for size in sizes if size <= FRAGMENT_SAFE_MSS]
+        return timeout, sizes
+    
+    def _probe_finished(self, rtt, start_mss):
+        # No probe answered and the peer hasn't been heard from: our final
+        # handshake ACK may be lost, and a half-open server drops probes, so
+        # probe again once it answers
+        if self.mss == start_mss and not self.peer_confirmed:
+            self.probe_retry_rtt = rtt
+    
+    # Sender
+    
+    def _prepare_segments(self, data, last_flags=0):
         segments = []
-        offset = 0
-        seq = self.next_to_send
+        seq = self.end_seq
         
-        while offset < len(data):
-            chunk = data[offset:offset + MAX_PAYLOAD_SIZE]
-            segment = Segment(0, self.server_port, self.client_port, seq, 0, chunk)
-            
-            if offset + len(chunk) >= len(data):
-                segment.set_termination()
+        message = data if isinstance(data, PreparedMessage) else PreparedMessage(data)
+        chunks = message.chunks(self.mss - HEADER_SIZE)
+        
+        for i, (chunk, payload, crc) in enumerate(chunks):
+            flags = TERM | last_flags if i == len(chunks) - 1 else 0
+            if self.peer_confirmed:
+                segment = self._make_segment(flags, seq, 0, chunk, (payload, crc))
+            else:
+                segment = self._make_segment(flags | ACK, seq, self.Rn, chunk, (payload, crc))
             
             segments.append((seq, segment))
             self.send_buffer[seq] = segment
-            offset += MAX_PAYLOAD_SIZE
             seq += 1
         
         return segments
     
-    def _check_and_slide_window(self):
-        with self.ack_lock:
-            if self.latest_ack > self.Sb:
-                old_sb = self.Sb
-                
-                for s in range(self.Sb, self.latest_ack):
-                    if s in self.send_buffer:
-                        del self.send_buffer[s]
-                
-                self.Sb = self.latest_ack
-                return True
-        return False
+    def _fill_window(self):
+        # Whatever the congestion window has room for goes out as one burst
+        end = min(self.Sb + self.congestion.window, self.end_seq)
+        if self.next_to_send < end:
+            burst = [seq for seq in range(self.next_to_send, end) if seq in self.send_buffer]
+            self.next_to_send = end
+            if burst:
+                self._send_segments(burst)
+    
+    def _send_segments(self, seqs):
+        sent_at = time.time()
+        for seq in seqs:
+            self.stats['segments_sent'] += 1
+            if seq in self.sent_at:
+                self.retransmitted.add(seq)
+                self.stats['segments_retransmitted'] += 1
+            self.sent_at[seq] = sent_at
+            self.expired.discard(seq)
+            self._cancel_retransmit_timer(seq)
+            self.retransmit_timers[seq] = self._call_later(self.rtt.rto, self._segment_expired, seq, sent_at)
+        
+        self.last_sent = sent_at
+        self._transmit_batch([self.send_buffer[seq] for seq in seqs])
+    
+    def _cancel_retransmit_timer(self, seq):
+        timer = self.retransmit_timers.pop(seq, None)
+        if timer is not None:
+            timer.cancel()
+    
+    def _retire(self, seq) -> Optional[float]:
+        # Drop an acknowledged segment; returns when it was last sent
+        if self.send_buffer.pop(seq, None) is None:
+            return None
+        self._cancel_retransmit_timer(seq)
+        return self.sent_at.pop(seq, None)
     
-    def _retransmit_window(self, segment_timestamps):
-        print(f"[CLIENT_SOCK {self.addr}] Retransmitting window from {self.Sb}")
+    def _segment_expired(self, seq, sent_at):
+        # A timer for an ACKed segment, or an earlier copy of one, is stale
+        if not self.connected or seq not in self.send_buffer or self.sent_at.get(seq) != sent_at:
+            return
+        self.retransmit_timers.pop(seq, None)
         
-        with self.send_lock:
-            self.next_to_send = self.Sb
+        if not self.selective_repeat:
+            # Go-Back-N only reacts to the oldest outstanding segment's timer
+            if seq == self.Sb:
+                self._retransmit_window()
+            else:
+                self.expired.add(seq)
+            return
         
-        current_time = time.time()
-        for seq in range(self.Sb, min(self.Sb + WINDOW_SIZE, self.next_to_send + WINDOW_SIZE)):
-            if seq in self.send_buffer:
-                segment = self.send_buffer[seq]
-                self.server_sock.sendto(segment.pack(), self.addr)
-                segment_timestamps[seq] = current_time
+        # Selective Repeat: only this segment is resent. Timers from one
+        # window firing together are one loss event; a retransmission timing
+        # out again is a new one
+        print(f"[{self.log_tag} {self.addr}] Retransmitting segment {seq} (rto={self.rtt.rto:.3f}s)")
+        if seq >= self.recovery_point or seq in self.retransmitted:
+            self.rtt.back_off()
+            self.congestion.on_timeout()
+            self.recovery_point = self.next_to_send
+        self._send_segments([seq])
     
-    def handle_received_segment(self, segment):
-        print(f"[CLIENT_SOCK {self.addr}] Handling segment: flags={bin(segment.flags)}, seq={segment.seq}, ack={segment.ack}")
+    def _retransmit_window(self):
+        print(f"[{self.log_tag} {self.addr}] Retransmitting window from {self.Sb} (rto={self.rtt.rto:.3f}s)")
+        self.rtt.back_off()
+        self.congestion.on_timeout()
+        self.expired.clear()
         
-        # Handle ACK
-        if (segment.flags & ACK) and not (segment.flags & (SYN | FIN)) and segment.ack > 0:
-            self._handle_ack_segment(segment)
+        # Go back to Sb, but only resend what the shrunken window allows;
+        # segments past it are resent, and retimed, as the window reopens
+        end = min(self.next_to_send, self.Sb + self.congestion.window)
+        for seq in range(end, self.next_to_send):
+            self._cancel_retransmit_timer(seq)
+        self.next_to_send = end
+        self._send_segments([seq for seq in range(self.Sb, end) if seq in self.send_buffer])
+    
+    def _fast_retransmit(self):
+        # Three duplicate ACKs: the segment at the cumulative ACK is lost but
+        # later ones are getting through, so resend it now rather than at RTO
+        seq = self.Sb
+        if seq not in self.send_buffer:
+            return
         
-        # Handle data
-        if len(segment.data) > 0 and not (segment.flags & (SYN | FIN)):
-            self._handle_data_segment(segment)
+        print(f"[{self.log_tag} {self.addr}] Fast retransmit of segment {seq}")
+        self.stats['fast_retransmits'] += 1
+        if seq >= self.recovery_point:
+            self.congestion.on_loss()
+            self.recovery_point = self.next_to_send
+        self._send_segments([seq])
         
-        # Handle FIN
-        if segment.flags & FIN:
-            self._handle_fin_segment(segment)
+        # A Go-Back-N receiver dropped everything after the hole, so resend that too
+        if not self.selective_repeat:
+            self.next_to_send = min(self.next_to_send, seq + 1)
     
     def _handle_ack_segment(self, segment):
-        with self.ack_lock:
-            if segment.ack > self.latest_ack:
-                self.latest_ack = segment.ack
-                self.ack_received.set()
+        # Retire everything covered by the cumulative ACK, plus (Selective
+        # Repeat) individually ACKed segments past a gap, which then never
+        # get retransmitted
+        now = time.time()
+        acked = 0
+        sample = None
+        progressed = False
+        
+        if segment.ack > self.Sb:
+            last = min(segment.ack, self.end_seq) - 1
+            for seq in range(self.Sb, last + 1):
+                sent_at = self._retire(seq)
+                if sent_at is not None:
+                    acked += 1
+                    # Karn's rule: a retransmitted segment's ACK is ambiguous, so no sample
+                    if seq == last and seq not in self.retransmitted:
+                        sample = now - sent_at
+                self.retransmitted.discard(seq)
+            
+            # The cumulative ACK can also cover only segments SACKed earlier
+            progressed = last + 1 > self.Sb
+            self.Sb = max(self.Sb, last + 1)
+            # Originals can still be ACKed after a timeout rewound next_to_send
+            self.next_to_send = max(self.next_to_send, self.Sb)
+            self.dup_acks = 0
+        elif (segment.ack == self.Sb and self.next_to_send > self.Sb and
+              (segment.flags & SACK or not len(segment.data))):
+            # The receiver re-ACKs Rn for every segment past a hole; data
+            # repeating the handshake ACK isn't one of those
+            self.dup_acks += 1
+            if self.dup_acks == DUP_ACK_THRESHOLD:
+                self._fast_retransmit()
+        
+        # Selective Repeat ACKs also name the segment that triggered them,
+        # and with SACK every range the receiver is holding past the gap;
+        # a FIN's seq is its own
+        if self.selective_repeat and not segment.flags & FIN:
+            acked_seqs = [segment.seq]
+            if segment.flags & SACK:
+                for start, end in decode_sack_blocks(segment.data):
+                    acked_seqs.extend(range(max(start, self.Sb), min(end, self.next_to_send)))
+            
+            for seq in acked_seqs:
+                if self.Sb <= seq < self.next_to_send:
+                    sent_at = self._retire(seq)
+                    if sent_at is not None:
+                        acked += 1
+                        if seq not in self.retransmitted:
+                            sample = now - sent_at
+        
+        if acked or progressed:
+            if sample is not None:
+                self.rtt.sample(sample)
+            else:
+                self.rtt.reset_backoff()
+            if acked:
+                self.congestion.on_ack(acked, self.rtt.srtt)
+        
+        if not self.selective_repeat and self.Sb in self.expired:
+            self._retransmit_window()
+        
+        while self.pending_sends and self.pending_sends[0][0] <= self.Sb:
+            self._complete(self.pending_sends.popleft()[1], True)
+        if self.Sb < self.end_seq:
+            self._fill_window()
+    
+    # Receiver
     
     def _handle_data_segment(self, segment):
-        with self.receive_lock:
-            if segment.seq == self.Rn:
-                print(f"[CLIENT_SOCK {self.addr}] Accepting segment {segment.seq}")
-                self.message_segments[segment.seq] = segment.data
-                self.Rn += 1
-                
-                if segment.is_termination():
-                    complete_message = self._assemble_message()
-                    if complete_message:
-                        self.message_queue.put(complete_message)
-                        self.message_segments.clear()
+        in_order = segment.seq == self.Rn
+        filled_gap = False
+        completed = []  # (message, flags) finished by this segment
+        if in_order:
+            self._accept_segment(segment, completed)
             
-            self._send_ack(self.Rn)
+            # A filled gap may release segments buffered behind it
+            filled_gap = bool(self.out_of_order)
+            while self.Rn in self.out_of_order:
+                self._accept_segment(self.out_of_order.pop(self.Rn), completed)
+        elif self.selective_repeat and self.Rn < segment.seq < self.Rn + MAX_WINDOW_SIZE:
+            self.out_of_order[segment.seq] = segment
+        
+        self.last_received_seq = segment.seq
+        
+        # Gaps, duplicates and message ends are ACKed at once: the sender
+        # needs them for fast retransmit and to finish send()
+        if (not self.delayed_ack or not in_order or filled_gap or segment.is_termination() or
+                self.unacked_segments + 1 >= DELAYED_ACK_SEGMENTS):
+            self._flush_ack()
+        else:
+            self.unacked_segments += 1
+            if self.delayed_ack_timer is None:
+                self.delayed_ack_timer = self._call_later(DELAYED_ACK_TIMEOUT, self._delayed_ack_expired)
+        
+        # Handed over only once ACKed, so a reader that closes straight away
+        # can't get its FIN to the sender ahead of the ACK
+        for message, flags in completed:
+            if flags & COALESCED:
+                self._deliver_coalesced(message)
+            else:
+                self.message_queue.put_nowait(message)
     
-    def _handle_fin_segment(self, segment):
-        print(f"[CLIENT_SOCK {self.addr}] Received FIN")
-        fin_ack = Segment(FIN | ACK, self.server_port, self.client_port, 
-                         self.seq_num, segment.seq + 1)
-        self.server_sock.sendto(fin_ack.pack(), self.addr)
-        self.connected = False
+    def _flush_ack(self):
+        # One ACK covers every segment held back
+        if self.delayed_ack_timer is not None:
+            self.delayed_ack_timer.cancel()
+            self.delayed_ack_timer = None
+        self.stats['acks_saved'] += self.unacked_segments
+        self.unacked_segments = 0
+        self._send_ack(self.Rn, self.last_received_seq)
+    
+    def _delayed_ack_expired(self):
+        self.delayed_ack_timer = None
+        if self.unacked_segments and self.connected:
+            self.stats['acks_saved'] += self.unacked_segments - 1
+            self.unacked_segments = 0
+            self._send_ack(self.Rn, self.last_received_seq)
+    
+    def _accept_segment(self, segment, completed):
+        self.message_segments.append(segment.data)
+        self.Rn += 1
+        
+        if segment.is_termination():
+            completed.append((b''.join(self.message_segments), segment.flags))
+            self.message_segments.clear()
     
-    def _assemble_message(self):
-        if not self.message_segments:
+    def _deliver_coalesced(self, data):
+        try:
+            messages = decode_coalesced(data)
+        except ValueError as e:
+            print(f"[{self.log_tag} {self.addr}] Bad coalesced message: {e}")
+            return
+        for message in messages:
+            self.message_queue.put_nowait(message)
+    
+    def _send_ack(self, ack_num, seq=0):
+        self.stats['acks_sent'] += 1
+        self.last_sent = time.time()
+        if self.sack and self.out_of_order:
+            blocks = encode_sack_blocks(self._sack_blocks(seq))
+            self._transmit(self._make_segment(ACK | SACK, seq, ack_num, blocks))
+        else:
+            self._transmit(self._make_segment(ACK, seq, ack_num))
+    
+    def _sack_blocks(self, latest_seq):
+        return _sack_ranges(self.out_of_order, latest_seq)
+
+class _Endpoint:
+    # The handshake, shared like _ReliableConnection by BetterUDPSocket and
+    # AsyncBetterUDPSocket: option negotiation and, on a listening socket,
+    # the half-open table with SYN-ACK retransmission, SYN cookies once it is
+    # full, and routing segments to accepted connections. Transports provide
+    # _send_to(segment, addr), _call_later(), a connection_queue with
+    # put_nowait(), and _open_connection(half_open, addr) building their
+    # kind of connection.
+    
+    def _init_endpoint(self, max_segment_size, congestion_control, selective_repeat, sack, delayed_ack,
+                       coalesce, coalesce_delay, max_half_open, syn_cookies):
+        # Largest segment we accept, advertised in the handshake
+        self.max_segment_size = max(MAX_SEGMENT_SIZE, min(max_segment_size, MAX_SEGMENT_SIZE_LIMIT))
+        self.congestion_control = congestion_control
+        
+        # Selective Repeat (and SACK on top of it) is used only if both ends
+        # offer it; Go-Back-N otherwise
+        self.selective_repeat_enabled = selective_repeat
+        self.sack_enabled = selective_repeat and sack
+        
+        # Receiver-side policy, no negotiation needed; accepted connections inherit it
+        self.delayed_ack = delayed_ack
+        
+        # Packing small messages together needs the peer to unpack them, so
+        # it's offered in the handshake like Selective Repeat
+        self.coalesce_enabled = coalesce
+        self.coalesce_delay = coalesce_delay
+        
+        # For server mode - multiple clients
+        self.clients = {}
+        self.half_open: Dict[Tuple[str, int], _HalfOpen] = {}  # SYN-ACK sent, final ACK pending
+        self.max_half_open = max_half_open
+        self.syn_cookies = syn_cookies
+        self.cookie_secret = os.urandom(16)
+        self.handshake_stats = {'syns_received': 0, 'accepted': 0, 'accepted_with_cookie': 0,
+                                'cookies_sent': 0, 'cookies_rejected': 0, 'dropped_table_full': 0,
+                                'timed_out': 0}
+    
+    def _send_to(self, segment: Segment, addr):
+        raise NotImplementedError
+    
+    def _call_later(self, delay: float, callback, *args):
+        raise NotImplementedError
+    
+    def _open_connection(self, half_open: _HalfOpen, addr):
+        raise NotImplementedError
+    
+    def _handshake_options(self) -> Dict[int, bytes]:
+        options = {OPT_MSS: MSS_STRUCT.pack(self.max_segment_size)}
+        if self.selective_repeat_enabled:
+            options[OPT_SELECTIVE_REPEAT] = b''
+        if self.sack_enabled:
+            options[OPT_SACK_PERMITTED] = b''
+        if self.coalesce_enabled:
+            options[OPT_COALESCE] = b''
+        return options
+    
+    def _negotiate(self, options: Dict[int, bytes]) -> Tuple[int, bool, bool, bool]:
+        # Segment size ceiling, Selective Repeat, SACK and coalescing, given the peer's options
+        selective_repeat = self.selective_repeat_enabled and OPT_SELECTIVE_REPEAT in options
+        sack = selective_repeat and self.sack_enabled and OPT_SACK_PERMITTED in options
+        coalesce = self.coalesce_enabled and OPT_COALESCE in options
+        return _negotiate_mss(self.max_segment_size, options), selective_repeat, sack, coalesce
+    
+    def _route_server_segment(self, segment, addr):
+        # The accepted connection that should handle segment, if any;
+        # handshakes are dealt with here
+        if segment.flags & SYN and not (segment.flags & ACK):
+            self._handle_new_connection(segment, addr)
+            return None
+        
+        # A handshake in progress comes first, as the address may belong to a
+        # connection that has since closed
+        if addr not in self.half_open:
+            client_sock = self.clients.get(addr)
+            if client_sock is not None:
+                return client_sock
+        
+        # Final ACK of a handshake in progress, or the client's first data
+        # carrying it; either way the new connection takes the segment
+        if segment.flags & ACK:
+            client_sock = self._complete_handshake(segment, addr)
+            if client_sock is not None:
+                return client_sock
+        
+        print(f"[SERVER] Received segment from unknown client {addr}")
+        return None
+    
+    def _handle_new_connection(self, segment, addr):
+        self.handshake_stats['syns_received'] += 1
+        if addr in self.half_open:
+            # The client retransmitted its SYN; answer straight away
+            self._send_synack(addr)
+            return
+        client_sock = self.clients.get(addr)
+        if client_sock is not None:
+            if client_sock.connected:
+                return
+            # Reconnecting from the address of a closed connection
+            del self.clients[addr]
+        
+        table_full = len(self.half_open) >= self.max_half_open
+        if table_full and not self.syn_cookies:
+            self.handshake_stats['dropped_table_full'] += 1
+            print(f"[SERVER] Half-open table full, dropping SYN from {addr}")
+            return
+        
+        print(f"[SERVER] New connection from {addr}")
+        
+        # Only answer with options if the client offered them; older clients expect none
+        client_options = decode_options(segment.data)
+        half_open = _HalfOpen()
+        half_open.client_port = segment.src_port
+        half_open.client_seq = segment.seq + 1
+        (half_open.negotiated_mss, half_open.selective_repeat, half_open.sack,
+         half_open.coalesce) = self._negotiate(client_options)
+        offered = {kind: value for kind, value in self._handshake_options().items()
+                   if kind == OPT_MSS or kind in client_options}
+        
+        if table_full:
+            # Stateless: the ISN remembers the negotiation, and nothing is
+            # retransmitted; a client that hears nothing resends its SYN.
+            # There's no room in the cookie for coalescing, so it isn't offered.
+            offered.pop(OPT_COALESCE, None)
+            synack_options = encode_options(offered) if client_options else b''
+            cookie = _syn_cookie(self.cookie_secret, addr, segment.seq, half_open.negotiated_mss,
+                                 half_open.selective_repeat, half_open.sack)
+            self._send_to(Segment(SYN | ACK, self.src_port, segment.src_port, cookie, segment.seq + 1,
+                                  synack_options), addr)
+            self.handshake_stats['cookies_sent'] += 1
+            print(f"[SERVER] Sent SYN cookie to {addr}")
+            return
+        
+        synack_options = encode_options(offered) if client_options else b''
+        half_open.server_seq = random.randint(1000, 9999)
+        half_open.synack = Segment(SYN | ACK, self.src_port, segment.src_port,
+                                   half_open.server_seq, segment.seq + 1, synack_options)
+        half_open.first_sent = time.time()
+        half_open.attempts = 0
+        half_open.timer = None
+        
+        self.half_open[addr] = half_open
+        self._send_synack(addr)
+    
+    def _send_synack(self, addr):
+        half_open = self.half_open[addr]
+        if half_open.timer is not None:
+            half_open.timer.cancel()
+        
+        if half_open.attempts >= SYNACK_RETRIES:
+            del self.half_open[addr]
+            self.handshake_stats['timed_out'] += 1
+            print(f"[SERVER] Failed to complete handshake with {addr}")
+            return
+        
+        half_open.attempts += 1
+        self._send_to(half_open.synack, addr)
+        print(f"[SERVER] Sent SYN-ACK to {addr}")
+        interval = TIMEOUT * 2 * 2 ** (half_open.attempts - 1)
+        half_open.timer = self._call_later(interval, self._synack_expired, addr, half_open, half_open.attempts)
+    
+    def _synack_expired(self, addr, half_open, attempt):
+        # Stale if the handshake finished or was re-sent since
+        if self.half_open.get(addr) is half_open and half_open.attempts == attempt:
+            self._send_synack(addr)
+    
+    def _complete_handshake(self, segment, addr):
+        half_open = self.half_open.get(addr)
+        if half_open is None:
+            half_open = self._half_open_from_cookie(segment, addr)
+            if half_open is None:
+                return None
+        elif segment.ack != half_open.server_seq + 1:
+            return None
+        else:
+            half_open.timer.cancel()
+            del self.half_open[addr]
+        
+        client_sock = self._open_connection(half_open, addr)
+        if half_open.attempts == 1:
+            client_sock.rtt.sample(time.time() - half_open.first_sent)
+        self.clients[addr] = client_sock
+        self.handshake_stats['accepted'] += 1
+        
+        self.connection_queue.put_nowait(client_sock)
+        print(f"[SERVER] Client {addr} connected successfully")
+        return client_sock
+    
+    def _half_open_from_cookie(self, segment, addr) -> Optional[_HalfOpen]:
+        # Any ACK from an unknown address may answer a SYN cookie: the final
+        # ACK, or if that was lost, the client's first segment repeating it
+        if not self.syn_cookies or not segment.flags & ACK or segment.flags & (SYN | FIN | PROBE):
+            return None
+        
+        negotiated = _check_syn_cookie(self.cookie_secret, addr, segment.seq - 1, segment.ack - 1)
+        if negotiated is None:
+            self.handshake_stats['cookies_rejected'] += 1
             return None
         
-        seq_numbers = sorted(self.message_segments.keys())
-        message_parts = [self.message_segments[seq] for seq in seq_numbers]
-        return b''.join(message_parts)
+        half_open = _HalfOpen()
+        half_open.server_seq = segment.ack - 1
+        half_open.client_seq = segment.seq
+        half_open.client_port = segment.src_port
+        half_open.negotiated_mss, half_open.selective_repeat, half_open.sack = negotiated
+        half_open.coalesce = False
+        half_open.attempts = 0  # no RTT sample: the SYN-ACK's send time wasn't kept
+        self.handshake_stats['accepted_with_cookie'] += 1
+        return half_open
     
-    def _send_ack(self, ack_num):
-        ack_segment = Segment(ACK, self.server_port, self.client_port, 0, ack_num)
-        self.server_sock.sendto(ack_segment.pack(), self.addr)
+    def _close_listener(self) -> list:
+        # Drops handshakes in progress; returns the accepted connections, for closing
+        for half_open in self.half_open.values():
+            half_open.timer.cancel()
+        self.half_open.clear()
+        return list(self.clients.values())
 
-class BetterUDPSocket:
-    def __init__(self, udp_socket=None):
+class _ThreadedConnection(_ReliableConnection):
+    # Runs the core for the thread-based sockets. The application's threads,
+    # the receiver thread and the timer wheel all call into it under
+    # self.lock; futures complete once it is released, since their
+    # callbacks may well send again.
+    
+    def _init_threading(self, timers: TimerWheel):
+        self.lock = threading.RLock()
+        self.completed = []  # (future, result, error), settled outside the lock
+        self.timers = timers
+        self.message_queue = Queue()
+    
+    def _locked(self, method, *args):
+        completed = []
+        try:
+            with self.lock:
+                try:
+                    return method(*args)
+                finally:
+                    completed, self.completed = self.completed, []
+        finally:
+            for future, result, error in completed:
+                _settle(future, result, error)
+    
+    def _call_later(self, delay, callback, *args):
+        return self.timers.schedule(delay, self._locked, callback, *args)
+    
+    def _new_future(self):
+        return Future()
+    
+    def _complete(self, future, result=None, error=None):
+        self.completed.append((future, result, error))
+    
+    def send(self, data: bytes):
+        # Blocks until the peer has ACKed the whole message
+        return self.send_async(data).result()
+    
+    def send_async(self, data) -> Future:
+        # Queues the message and returns at once; see _send_message
+        return self._locked(self._send_message, data)
+    
+    def handle_received_segment(self, segment):
+        self._locked(self.handle_segment, segment)
+
+class BetterUDPClientSocket(_ThreadedConnection):
+    def __init__(self, server_sock, client_addr, server_port, client_port, seq_num, ack_num,
+                 negotiated_mss=MAX_SEGMENT_SIZE, congestion_control=CONGESTION_CONTROL,
+                 selective_repeat=False, sack=False, delayed_ack=True,
+                 timers: Optional[TimerWheel] = None, datagram_io: Optional[DatagramIO] = None,
+                 coalesce=False, coalesce_delay=COALESCE_DELAY):
+        self.server_sock = server_sock
+        self.addr = client_addr
+        self.server_port = server_port
+        self.client_port = client_port
+        self.seq_num = seq_num
+        self.ack_num = ack_num
+        self.connected = True
+        
+        # Segment size: agreed ceiling from the handshake, raised towards it
+        # as the client's path MTU probes get through
+        self.negotiated_mss = negotiated_mss
+        self.mss = MAX_SEGMENT_SIZE
+        
+        self.congestion_control = congestion_control
+        self.selective_repeat = selective_repeat
+        self.sack = sack
+        self.delayed_ack = delayed_ack
+        self.coalesce = coalesce
+        self.coalesce_delay = coalesce_delay
+        
+        # Retransmit, delayed-ACK and FIN timers live on the listening socket's wheel
+        self.datagram_io = datagram_io or DatagramIO()
+        self.fin_done = threading.Event()
+        self._init_threading(timers or TimerWheel())
+        self._init_transfer_state(seq_num, ack_num)
+        self._start_keepalive()
+    
+    def _make_segment(self, flags, seq, ack, data=b'', prepared=None):
+        return Segment(flags, self.server_port, self.client_port, seq, ack, data, prepared)
+    
+    def _transmit(self, segment):
+        self.server_sock.sendto(segment.pack(), self.addr)
+    
+    def _transmit_batch(self, segments):
+        self.datagram_io.send_batch(self.server_sock, [segment.pack() for segment in segments], self.addr)
+    
+    def _fin_acked(self):
+        self.fin_done.set()
+    
+    def receive(self) -> Optional[bytes]:
+        # Messages that arrived before the client closed are still handed out
+        if not self.connected and self.message_queue.empty():
+            raise RuntimeError("Not connected")
+        
+        try:
+            message = self.message_queue.get(timeout=10.0)
+            print(f"[CLIENT_SOCK {self.addr}] Received message ({len(message)} bytes)")
+            return message
+        except Empty:
+            return None
+    
+    def close(self):
+        fin_segment = self._locked(self._shut_down)
+        if fin_segment is None:
+            return
+        
+        print(f"[CLIENT_SOCK {self.addr}] Closing connection")
+        
+        # FIN retransmissions run on the wheel, so closing doesn't block the caller
+        self._send_fin(fin_segment, RETRIES)
+    
+    def _shut_down(self) -> Optional[Segment]:
+        fin_segment = self._fin_segment()
+        if fin_segment is not None:
+            self._connection_closed()
+        return fin_segment
+    
+    def _send_fin(self, fin_segment, remaining):
+        if self.fin_done.is_set():
+            return
+        
+        try:
+            self.server_sock.sendto(fin_segment.pack(), self.addr)
+            print(f"[CLIENT_SOCK {self.addr}] Sent FIN")
+        except OSError:
+            remaining = 1
+        
+        if remaining > 1:
+            self.timers.schedule(FIN_INTERVAL, self._send_fin, fin_segment, remaining - 1)
+        else:
+            self.fin_done.set()
+    
+    def handle_received_segment(self, segment):
+        print(f"[CLIENT_SOCK {self.addr}] Handling segment: flags={bin(segment.flags)}, seq={segment.seq}, ack={segment.ack}")
+        super().handle_received_segment(segment)
+
+class BetterUDPSocket(_ThreadedConnection, _Endpoint):
+    def __init__(self, udp_socket=None, max_segment_size=MAX_SEGMENT_SIZE_LIMIT,
+                 congestion_control=CONGESTION_CONTROL, selective_repeat=True, sack=True,
+                 delayed_ack=True, max_half_open=MAX_HALF_OPEN, syn_cookies=True, batched_io=False,
+                 udp_offload=False, coalesce=False, coalesce_delay=COALESCE_DELAY):
         self.sock = udp_socket or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(0.1)
         self.addr = None
         
+        # Large negotiated segments need more room than the default socket buffer
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError:
+            pass
+        
         try:
             self.src_port = self.sock.getsockname()[1]
         except (OSError, socket.error):
@@ -316,30 +1386,64 @@ class BetterUDPSocket:
         self.seq_num = random.randint(1000, 9999)
         self.ack_num = 0
         self.connected = False
+        self._init_endpoint(max_segment_size, congestion_control, selective_repeat, sack, delayed_ack,
+                            coalesce, coalesce_delay, max_half_open, syn_cookies)
+        
+        # The agreed segment size ceiling, and the size currently confirmed
+        # safe by path MTU probing
+        self.negotiated_mss = MAX_SEGMENT_SIZE
+        self.mss = MAX_SEGMENT_SIZE
+        self.probe_acked = threading.Event()
+        self.probe_confirmed = 0
+        self.final_ack: Optional[Segment] = None  # re-sent if the SYN-ACK arrives again
+        self.fin_done = threading.Event()
+        
+        # What the handshake agreed, in client mode
+        self.selective_repeat = False
+        self.sack = False
+        self.coalesce = False
+        
+        # One timer wheel serves this socket and every connection it accepts,
+        # and so does the datagram I/O path (recvmmsg/sendmmsg when batched_io
+        # is asked for, or UDP GSO/GRO for udp_offload, if the kernel has them)
+        self.datagram_io = create_datagram_io(batched_io, udp_offload)
+        self.datagram_io.configure(self.sock)
         
-        # For server mode - multiple clients
-        self.clients: Dict[Tuple[str, int], BetterUDPClientSocket] = {}
-        self.clients_lock = threading.RLock()
         self.server_mode = False
         self.running = False
         self.receiver_thread = None
         self.connection_queue = Queue()
         
-        # Original single-client variables (for client mode)
-        self.Sb = 0
-        self.Sm = 0
-        self.N = WINDOW_SIZE
-        self.next_to_send = 0
-        self.Rn = 0
-        self.send_buffer = {}
-        self.ack_received = threading.Event()
-        self.latest_ack = 0
-        self.ack_lock = threading.Lock()
-        self.message_queue = Queue()
-        self.message_segments = {}
-        self.receive_lock = threading.Lock()
-        self.sending_complete = False
-        self.send_lock = threading.Lock()
+        # The client mode connection; in server mode the same lock guards the handshakes
+        self._init_threading(TimerWheel())
+        self._init_transfer_state(0, 0)
+    
+    def _make_segment(self, flags, seq, ack, data=b'', prepared=None):
+        return Segment(flags, self.src_port, self.dest_port, seq, ack, data, prepared)
+    
+    def _transmit(self, segment):
+        self.sock.sendto(segment.pack(), self.addr)
+    
+    def _transmit_batch(self, segments):
+        self.datagram_io.send_batch(self.sock, [segment.pack() for segment in segments], self.addr)
+    
+    def _send_to(self, segment, addr):
+        self.sock.sendto(segment.pack(), addr)
+    
+    def _open_connection(self, half_open, addr) -> BetterUDPClientSocket:
+        return BetterUDPClientSocket(
+            self.sock, addr, self.src_port, half_open.client_port,
+            half_open.server_seq + 1, half_open.client_seq, half_open.negotiated_mss,
+            self.congestion_control, half_open.selective_repeat, half_open.sack,
+            self.delayed_ack, self.timers, self.datagram_io, half_open.coalesce, self.coalesce_delay
+        )
+    
+    def _fin_acked(self):
+        self.fin_done.set()
+    
+    def _probe_acked(self, size):
+        self.probe_confirmed = size
+        self.probe_acked.set()
     
     def listen(self):
         self.server_mode = True
@@ -367,19 +1471,20 @@ class BetterUDPSocket:
     def _receiver_loop(self):
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(MAX_SEGMENT_SIZE)  # Use optimized size
+                datagrams = self.datagram_io.recv_batch(self.sock)
                 
-                try:
-                    segment = Segment.unpack(data)
-                    #print(f"[RECV] Received segment from {addr}: flags={bin(segment.flags)}, seq={segment.seq}, ack={segment.ack}")
-                    if self.server_mode:
-                        self._handle_server_segment(segment, addr)
-                    else:
-                        self._handle_client_segment(segment, addr)
-                        
-                except ValueError as e:
-                    print(f"[RECV] Bad packet from {addr}: {e}")
-                    continue
+                for data, addr in datagrams:
+                    try:
+                        segment = Segment.unpack(data)
+                        #print(f"[RECV] Received segment from {addr}: flags={bin(segment.flags)}, seq={segment.seq}, ack={segment.ack}")
+                        if self.server_mode:
+                            self._handle_server_segment(segment, addr)
+                        else:
+                            self._locked(self._handle_client_segment, segment, addr)
+                            
+                    except ValueError as e:
+                        print(f"[RECV] Bad packet from {addr}: {e}")
+                        continue
                     
             except socket.timeout:
                 continue
@@ -387,79 +1492,32 @@ class BetterUDPSocket:
                 break
     
     def _handle_server_segment(self, segment, addr):
-        # Handle new connection (SYN)
-        if segment.flags & SYN and not (segment.flags & ACK):
-            self._handle_new_connection(segment, addr)
-            return
-        
-        # Handle existing client
-        with self.clients_lock:
-            if addr in self.clients:
-                client_sock = self.clients[addr]
-                client_sock.handle_received_segment(segment)
-            else:
-                print(f"[SERVER] Received segment from unknown client {addr}")
-    
-    def _handle_new_connection(self, segment, addr):
-        print(f"[SERVER] New connection from {addr}")
-        
-        # Send SYN-ACK
-        server_seq = random.randint(1000, 9999)
-        ack_num = segment.seq + 1
-        
-        synack_segment = Segment(SYN | ACK, self.src_port, segment.src_port, 
-                               server_seq, ack_num)
-        
-        for attempt in range(RETRIES):
-            self.sock.sendto(synack_segment.pack(), addr)
-            print(f"[SERVER] Sent SYN-ACK to {addr}")
-            
-            # Wait for final ACK
-            start_time = time.time()
-            while time.time() - start_time < TIMEOUT * 2:
-                try:
-                    data, client_addr = self.sock.recvfrom(MAX_SEGMENT_SIZE)
-                    if client_addr == addr:
-                        try:
-                            ack_segment = Segment.unpack(data)
-                            if (ack_segment.flags & ACK) and ack_segment.ack == server_seq + 1:
-                                # Connection established
-                                client_sock = BetterUDPClientSocket(
-                                    self.sock, addr, self.src_port, segment.src_port,
-                                    server_seq + 1, ack_segment.seq
-                                )
-                                
-                                with self.clients_lock:
-                                    self.clients[addr] = client_sock
-                                
-                                self.connection_queue.put(client_sock)
-                                print(f"[SERVER] Client {addr} connected successfully")
-                                return
-                        except ValueError:
-                            continue
-                except socket.timeout:
-                    continue
-        
-        raise TimeoutError("Failed to establish connection with client")
-        print(f"[SERVER] Failed to complete handshake with {addr}")
+        # Routed under this socket's lock, handled under the connection's
+        client_sock = self._locked(self._route_server_segment, segment, addr)
+        if client_sock is not None:
+            client_sock.handle_received_segment(segment)
     
     def _handle_client_segment(self, segment, addr):
         if addr == self.addr:
             print(f"[CLIENT] Received segment: flags={bin(segment.flags)}, seq={segment.seq}, ack={segment.ack}")
             
-            if (segment.flags & ACK) and not (segment.flags & (SYN | FIN)) and segment.ack > 0:
-                self._handle_ack_segment(segment)
+            if (segment.flags & (SYN | ACK)) == (SYN | ACK):
+                # Our final ACK was lost and the server is still retransmitting
+                self.last_heard = time.time()
+                if self.final_ack is not None:
+                    self._transmit(self.final_ack)
+                return
             
-            if len(segment.data) > 0 and not (segment.flags & (SYN | FIN)):
-                self._handle_data_segment(segment)
+            self.handle_segment(segment)
     
     def connect(self, ip_address: str, port: int):
         self.addr = (ip_address, port)
         self.dest_port = port
         self._update_src_port()
         
-        # 3-way handshake
-        syn_segment = Segment(SYN, self.src_port, self.dest_port, self.seq_num, 0)
+        # 3-way handshake, offering the largest segment we can take
+        syn_options = encode_options(self._handshake_options())
+        syn_segment = Segment(SYN, self.src_port, self.dest_port, self.seq_num, 0, syn_options)
         
         for attempt in range(RETRIES):
             self.sock.sendto(syn_segment.pack(), self.addr)
@@ -469,26 +1527,34 @@ class BetterUDPSocket:
                 start_time = time.time()
                 while time.time() - start_time < TIMEOUT:
                     try:
-                        data, addr = self.sock.recvfrom(MAX_SEGMENT_SIZE)
+                        data, addr = self.sock.recvfrom(MAX_SEGMENT_SIZE_LIMIT)
                         if addr == self.addr:
                             segment = Segment.unpack(data)
                             if (segment.flags & (SYN | ACK)) == (SYN | ACK) and segment.ack == self.seq_num + 1:
+                                handshake_rtt = time.time() - start_time
+                                
                                 # Send final ACK
                                 self.ack_num = segment.seq + 1
                                 self.seq_num += 1
                                 ack_segment = Segment(ACK, self.src_port, self.dest_port, 
                                                     self.seq_num, self.ack_num)
                                 self.sock.sendto(ack_segment.pack(), self.addr)
+                                self.final_ack = ack_segment
                                 print(f"[CLIENT] Connected to {self.addr}")
                                 
                                 # Initialize Go-Back-N
                                 self.connected = True
-                                self.Sb = self.seq_num
-                                self.Sm = self.Sb + self.N - 1
-                                self.next_to_send = self.Sb
-                                self.Rn = self.ack_num
+                                self._init_transfer_state(self.seq_num, self.ack_num)
+                                self.peer_confirmed = False
+                                (self.negotiated_mss, self.selective_repeat, self.sack,
+                                 self.coalesce) = self._negotiate(decode_options(segment.data))
+                                if attempt == 0:
+                                    self.rtt.sample(handshake_rtt)
                                 
                                 self._start_receiver_thread()
+                                self._locked(self._start_keepalive)
+                                if self.negotiated_mss > MAX_SEGMENT_SIZE:
+                                    self._probe_path_mtu(handshake_rtt)
                                 return
                     except (ValueError, socket.timeout):
                         continue
@@ -497,6 +1563,45 @@ class BetterUDPSocket:
         
         raise TimeoutError("Connection failed")
     
+    def _retry_probe(self, rtt):
+        threading.Thread(target=self._probe_path_mtu, args=(rtt,), daemon=True).start()
+    
+    def _probe_path_mtu(self, rtt):
+        dont_fragment = _set_dont_fragment(self.sock, True)
+        timeout, sizes = self._probe_plan(rtt, dont_fragment)
+        start_mss = self.mss
+        
+        try:
+            for size in sizes:
+                if size <= self.mss:
+                    continue
+                if not self._send_probe(size, timeout):
+                    break
+                self.mss = size
+        finally:
+            if dont_fragment:
+                _set_dont_fragment(self.sock, False)
+        
+        self._locked(self._probe_finished, rtt, start_mss)
+        print(f"[CLIENT] Segment size {self.mss} (negotiated {self.negotiated_mss})")
+    
+    def _send_probe(self, size, timeout):
+        probe = Segment(PROBE, self.src_port, self.dest_port, 0, 0, bytes(size - HEADER_SIZE))
+        
+        for attempt in range(PROBE_ATTEMPTS):
+            self.probe_acked.clear()
+            try:
+                self.sock.sendto(probe.pack(), self.addr)
+            except OSError as e:
+                # EMSGSIZE: already larger than the path MTU the kernel knows about
+                if e.errno == errno.EMSGSIZE:
+                    return False
+                raise
+            
+            if self.probe_acked.wait(timeout) and self.probe_confirmed >= size:
+                return True
+        return False
+    
     def _update_src_port(self):
         try:
             if self.src_port == 0:
@@ -504,13 +1609,9 @@ class BetterUDPSocket:
         except (OSError, socket.error):
             pass
     
-    def send(self, data: bytes):
-        if not self.connected:
-            raise RuntimeError("Not connected")
-        return self._send_go_back_n_pipelined(data)
-    
     def receive(self) -> Optional[bytes]:
-        if not self.connected:
+        # Messages that arrived before the server closed are still handed out
+        if not self.connected and self.message_queue.empty():
             raise RuntimeError("Not connected")
         
         try:
@@ -527,152 +1628,36 @@ class BetterUDPSocket:
     
     def _close_server(self):
         self.running = False
+        client_socks = self._locked(self._close_listener)
         
-        with self.clients_lock:
-            for client_sock in list(self.clients.values()):
-                client_sock.close()
-            self.clients.clear()
+        # Every client's FINs go out in parallel on the wheel; wait for them to finish
+        for client_sock in client_socks:
+            client_sock.close()
+        for client_sock in client_socks:
+            client_sock.fin_done.wait(RETRIES * FIN_INTERVAL + 1)
         
         if self.receiver_thread:
             self.receiver_thread.join(timeout=1)
         
+        self.timers.stop()
         self.sock.close()
     
     def _close_client(self):
-        if not self.connected:
-            return
+        # The server may have closed first; either way the socket goes
+        fin_segment = self._locked(self._fin_segment)
+        if fin_segment is not None:
+            # Sent under the lock like every other segment, so it can't
+            # overtake an ACK the receiver thread is about to send.
+            # The receiver thread keeps running to hear the server's FIN-ACK
+            for attempt in range(RETRIES):
+                self._locked(self._transmit, fin_segment)
+                if self.fin_done.wait(FIN_INTERVAL):
+                    break
+            self._locked(self._connection_closed)
         
         self.running = False
-        fin_segment = Segment(FIN, self.src_port, self.dest_port, self.seq_num, 0)
-        
-        for attempt in range(RETRIES):
-            self.sock.sendto(fin_segment.pack(), self.addr)
-            time.sleep(0.1)
-        
-        self.connected = False
         if self.receiver_thread:
             self.receiver_thread.join(timeout=1)
         
+        self.timers.stop()
         self.sock.close()
-    
-    def _send_go_back_n_pipelined(self, data: bytes):
-        segments = self._prepare_segments(data)
-        if not segments:
-            return False
-        
-        base_seq = self.next_to_send
-        total_segments = len(segments)
-        
-        with self.send_lock:
-            self.Sb = base_seq
-            self.next_to_send = base_seq
-            self.latest_ack = base_seq
-            self.sending_complete = False
-        
-        segment_timestamps = {}
-        
-        while self.Sb < base_seq + total_segments:
-            upper_bound = min(self.Sb + self.N, base_seq + total_segments)
-            while (self.next_to_send < self.Sb + self.N and 
-                   self.next_to_send < base_seq + total_segments):
-                
-                seq = self.next_to_send
-                if seq in self.send_buffer:
-                    segment = self.send_buffer[seq]
-                    self.sock.sendto(segment.pack(), self.addr)
-                    segment_timestamps[seq] = time.time()
-                    
-                    with self.send_lock:
-                        self.next_to_send += 1
-            
-            if self._check_and_slide_window():
-                continue
-
-            current_time = time.time()
-            for seq in range(self.Sb, upper_bound):
-                if seq in segment_timestamps:
-                    if current_time - segment_timestamps[seq] > SEGMENT_TIMEOUT:
-                        self._retransmit_window(segment_timestamps)
-                        print(f"[CLIENT_SOCK {self.addr}] Retransmitting segment {seq}") 
-                        break
-            
-            time.sleep(0.001)
-        
-        self.sending_complete = True
-        return True
-    
-    def _prepare_segments(self, data: bytes):
-        segments = []
-        offset = 0
-        seq = self.next_to_send
-        
-        while offset < len(data):
-            chunk = data[offset:offset + MAX_PAYLOAD_SIZE]
-            segment = Segment(0, self.src_port, self.dest_port, seq, 0, chunk)
-            
-            if offset + len(chunk) >= len(data):
-                segment.set_termination()
-            
-            segments.append((seq, segment))
-            self.send_buffer[seq] = segment
-            offset += MAX_PAYLOAD_SIZE
-            seq += 1
-        
-        return segments
-    
-    def _check_and_slide_window(self):
-        with self.ack_lock:
-            if self.latest_ack > self.Sb:
-                old_sb = self.Sb
-                
-                for s in range(self.Sb, self.latest_ack):
-                    if s in self.send_buffer:
-                        del self.send_buffer[s]
-                
-                self.Sb = self.latest_ack
-                return True
-        return False
-    
-    def _retransmit_window(self, segment_timestamps):
-        with self.send_lock:
-            self.next_to_send = self.Sb
-        
-        current_time = time.time()
-        for seq in range(self.Sb, min(self.Sb + self.N, self.next_to_send + self.N)):
-            if seq in self.send_buffer:
-                segment = self.send_buffer[seq]
-                self.sock.sendto(segment.pack(), self.addr)
-                segment_timestamps[seq] = current_time
-    
-    def _handle_ack_segment(self, segment):
-        print(f"[CLIENT_SOCK {self.addr}] Handling ACK segment: ack={segment.ack}")
-        with self.ack_lock:
-            if segment.ack > self.latest_ack:
-                self.latest_ack = segment.ack
-                self.ack_received.set()
-    
-    def _handle_data_segment(self, segment):
-        with self.receive_lock:
-            if segment.seq == self.Rn:
-                self.message_segments[segment.seq] = segment.data
-                self.Rn += 1
-                
-                if segment.is_termination():
-                    complete_message = self._assemble_message()
-                    if complete_message:
-                        self.message_queue.put(complete_message)
-                        self.message_segments.clear()
-            
-            self._send_ack(self.Rn)
-    
-    def _assemble_message(self):
-        if not self.message_segments:
-            return None
-        
-        seq_numbers = sorted(self.message_segments.keys())
-        message_parts = [self.message_segments[seq] for seq in seq_numbers]
-        return b''.join(message_parts)
-    
-    def _send_ack(self, ack_num):
-        ack_segment = Segment(ACK, self.src_port, self.dest_port, 0, ack_num)
-        self.sock.sendto(ack_segment.pack(), self.addr)
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable
+
+OUTBOX_LIMIT = 256      # queued messages per recipient before the oldest are dropped
+OUTBOX_IN_FLIGHT = 32   # messages handed to the connection and not yet ACKed
+LATENCY_SMOOTHING = 0.125
+FLUSH_TIMEOUT = 5.0
+
+
+class Outbox:
+    # One recipient's queue and the thread draining it into the connection.
+    # Up to OUTBOX_IN_FLIGHT messages share the connection's window (and can
+    # be coalesced into shared segments); the rest wait here, so a slow or
+    # lossy recipient only ever holds up its own queue.
+    def __init__(self, sock, name: str, limit: int = OUTBOX_LIMIT):
+        self.sock = sock
+        self.name = name
+        self.limit = limit
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.in_flight = 0
+
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'failed': 0,
+                      'latency_avg': 0.0, 'latency_max': 0.0, 'latency_last': 0.0}
+
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def put(self, data: bytes):
+        with self.condition:
+            if len(self.pending) >= self.limit:
+                # Slow consumer: shed its oldest message rather than grow without bound
+                self.pending.popleft()
+                self.stats['dropped'] += 1
+            self.pending.append((data, time.time()))
+            self.stats['queued'] += 1
+            self.condition.notify()
+
+    def flush(self, deadline: float):
+        with self.condition:
+            while self.running and (self.pending or self.in_flight):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.pending.clear()
+            self.condition.notify_all()
+
+    def _drain(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.pending or self.in_flight >= OUTBOX_IN_FLIGHT):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                data, queued_at = self.pending.popleft()
+                self.in_flight += 1
+
+            try:
+                future = self.sock.send_async(data)
+            except Exception as e:
+                self._delivered(queued_at, e)
+                if not getattr(self.sock, 'connected', True):
+                    self.close()
+                    return
+                continue
+            future.add_done_callback(lambda done, queued_at=queued_at: self._delivered(queued_at, done.exception()))
+
+    def _delivered(self, queued_at, error):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+        if error is not None:
+            self.stats['failed'] += 1
+            print(f"[FANOUT] Failed to send to {self.name}: {error}")
+            return
+
+        # Delivery latency: from hand-off to the recipient's final ACK
+        latency = time.time() - queued_at
+        stats = self.stats
+        stats['sent'] += 1
+        stats['latency_last'] = latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        if stats['sent'] == 1:
+            stats['latency_avg'] = latency
+        else:
+            stats['latency_avg'] += LATENCY_SMOOTHING * (latency - stats['latency_avg'])
+
+
+class FanOut:
+    # Hands each message to per-recipient outboxes and returns immediately;
+    # every outbox sends concurrently and in order for its own recipient.
+    def __init__(self, limit: int = OUTBOX_LIMIT):
+        self.limit = limit
+        self.outboxes: Dict[object, Outbox] = {}
+        self.lock = threading.Lock()
+
+    def add(self, sock, name: str):
+        with self.lock:
+            if sock not in self.outboxes:
+                self.outboxes[sock] = Outbox(sock, name, self.limit)
+
+    def rename(self, sock, name: str):
+        with self.lock:
+            outbox = self.outboxes.get(sock)
+            if outbox:
+                outbox.name = name
+
+    def remove(self, sock):
+        with self.lock:
+            outbox = self.outboxes.pop(sock, None)
+        if outbox:
+            outbox.close()
+
+    def send(self, sock, data: bytes) -> bool:
+        with self.lock:
+            outbox = self.outboxes.get(sock)
+        if outbox is None:
+            return False
+        outbox.put(data)
+        return True
+
+    def publish(self, data: bytes, recipients: Iterable) -> int:
+        return sum(self.send(sock, data) for sock in recipients)
+
+    def stats(self) -> Dict[str, dict]:
+        with self.lock:
+            outboxes = list(self.outboxes.values())
+        return {outbox.name: dict(outbox.stats, backlog=len(outbox.pending)) for outbox in outboxes}
+
+    def flush(self, timeout: float = FLUSH_TIMEOUT):
+        # Wait (up to timeout overall) for everything queued so far to be delivered
+        deadline = time.time() + timeout
+        with self.lock:
+            outboxes = list(self.outboxes.values())
+        for outbox in outboxes:
+            outbox.flush(deadline)
+
+    def close(self):
+        with self.lock:
+            outboxes = list(self.outboxes.values())
+            self.outboxes.clear()
+        for outbox in outboxes:
+            outbox.close()
@@ -2,7 +2,6 @@ import sys
 import os
 import json
 import threading
-import time
 from datetime import datetime
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -303,7 +302,7 @@ class KessokuChatRoom(QMainWindow):
         self.messages = []
         self.setup_ui()
         self.setup_style()
-        self.socket = BetterUDPSocket()
+        self.socket = BetterUDPSocket(coalesce=True)
         self.host = host
         self.port = port
         self.running = True
@@ -369,18 +368,6 @@ class KessokuChatRoom(QMainWindow):
 
         return header
     
-    def send_heartbeat(self):
-        while self.running:
-            try:
-                time.sleep(1)  # Send heartbeat every 1 second
-                if self.running and hasattr(self, 'socket'):
-                    # Send a special heartbeat message
-                    self.socket.send("__HEARTBEAT__".encode())
-            except Exception as e:
-                if self.running:
-                    print(f"[CLIENT] Heartbeat error: {e}")
-                break       
-
     def create_chat_area(self):
         chat_frame = QFrame()
         chat_layout = QVBoxLayout(chat_frame)
@@ -715,6 +702,9 @@ class KessokuChatRoom(QMainWindow):
                             print(f"\n[SYSTEM] {message}")
                             self.message_received.emit("SYSTEM", message, datetime.now().strftime("%H:%M"), False)
                 else:
+                    # Nothing to read, but the transport is still hearing from the server
+                    if self.socket.peer_alive():
+                        continue
                     if self.running:
                         print("\n[CLIENT] Connection lost or server closed")
                         print("\n[CLIENT] Retrying")
@@ -763,10 +753,6 @@ class KessokuChatRoom(QMainWindow):
         self.listenThread = threading.Thread(target=self.listen_for_messages, daemon=True)
         self.listenThread.start()
 
-        
-        self.heartbeatThread = threading.Thread(target=self.send_heartbeat, daemon=True)
-        self.heartbeatThread.start()
-
     def refresh_chat_history(self):
         """Clear all current messages and reload only from history_messages"""
         # Clear all current chat widgets
@@ -0,0 +1,71 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+
+class ClientRegistry:
+    # Connected clients indexed by name, address and connection. All changes
+    # happen under one lock, so a name is never held by two clients even while
+    # joins, leaves and renames race. Readers get an immutable tuple that is
+    # rebuilt only when membership changes, so broadcasts neither copy the
+    # room nor take the lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name: Dict[str, dict] = {}
+        self.by_addr: Dict[tuple, dict] = {}
+        self.by_sock: Dict[object, dict] = {}
+        self._snapshot: Tuple[dict, ...] = ()
+
+    def add(self, client: dict) -> bool:
+        with self.lock:
+            if client['name'] in self.by_name or client['sock'] in self.by_sock:
+                return False
+            self.by_name[client['name']] = client
+            self.by_addr[client['addr']] = client
+            self.by_sock[client['sock']] = client
+            self._snapshot = self._snapshot + (client,)
+            return True
+
+    def remove(self, client: dict) -> bool:
+        # Only the first caller wins, so cleanup racing with itself runs once
+        with self.lock:
+            if self.by_sock.get(client['sock']) is not client:
+                return False
+            del self.by_sock[client['sock']]
+            del self.by_name[client['name']]
+            if self.by_addr.get(client['addr']) is client:
+                del self.by_addr[client['addr']]
+            client['removed'] = True
+            self._snapshot = tuple(c for c in self._snapshot if c is not client)
+            return True
+
+    def rename(self, client: dict, new_name: str) -> bool:
+        # Check and claim the new name in one step; the snapshot holds the same
+        # dicts, so it sees the new name without being rebuilt
+        with self.lock:
+            if self.by_sock.get(client['sock']) is not client:
+                return False
+            holder = self.by_name.get(new_name)
+            if holder is not None and holder is not client:
+                return False
+            del self.by_name[client['name']]
+            client['name'] = new_name
+            self.by_name[new_name] = client
+            return True
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        return self.by_name.get(name)
+
+    def get_by_addr(self, addr: tuple) -> Optional[dict]:
+        return self.by_addr.get(addr)
+
+    def get_by_sock(self, sock) -> Optional[dict]:
+        return self.by_sock.get(sock)
+
+    def snapshot(self) -> Tuple[dict, ...]:
+        return self._snapshot
+
+    def __contains__(self, client: dict) -> bool:
+        return self.by_sock.get(client['sock']) is client
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
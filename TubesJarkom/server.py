@@ -1,15 +1,40 @@
-from custom_socket import BetterUDPSocket
+from custom_socket import BetterUDPSocket, PreparedMessage
+from fanout import FanOut
+from registry import ClientRegistry
+from shard_bus import ShardBus
+import multiprocessing
+import shutil
+import socket
+import sys
+import tempfile
 import time
-from threading import Thread, Lock
+from threading import Thread
+
+HEARTBEAT_TIMEOUT = 30.0
 
 class Server:
-    def __init__(self, HOST, PORT):
-        self.clients = []  # Changed from class variable to instance variable
-        self.clients_lock = Lock() 
-        self.socket = BetterUDPSocket()
+    def __init__(self, HOST, PORT, reuse_port=False, bus=None):
+        self.clients = ClientRegistry()
+        # Busy rooms send many short lines; coalescing packs them into shared segments
+        self.socket = BetterUDPSocket(coalesce=True)
+        if reuse_port:
+            # Every shard binds the same port; the kernel hashes each client
+            # address to one of them, so a connection stays on its shard
+            self.socket.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.sock.bind((HOST, PORT))
         self.socket.listen()
         self.running = True
+        
+        # Everything sent to a client goes through its outbox, so one slow
+        # client never holds up the others (or the thread that sent it)
+        self.fanout = FanOut()
+        
+        # Chat from clients on other shards arrives over the bus
+        self.bus = bus
+        if bus:
+            # Broadcasts from other shards go to every local client
+            bus.subscribe('broadcast', lambda event: self._broadcast_local(event['sender'], event['message']))
+            bus.subscribe('shutdown', lambda event: self._stop())
         print(f"[SERVER] Listening on {HOST}:{PORT}")
 
     def listen(self):
@@ -18,14 +43,24 @@ class Server:
         connection_thread = Thread(target=self._handle_connections, daemon=True)
         connection_thread.start()
         
-        heartbeat_thread = Thread(target=self._monitor_heartbeat, daemon=True)
-        heartbeat_thread.start()
         try:
             while self.running:
                 time.sleep(0.1)
         except KeyboardInterrupt:
             print("\n[SERVER] Shutting down server...")
             self.running = False
+        
+        self.fanout.flush()
+        for name, stats in self.fanout.stats().items():
+            print(f"[SERVER] {name}: sent {stats['sent']}, dropped {stats['dropped']}, "
+                  f"latency avg {stats['latency_avg'] * 1000:.1f} ms, max {stats['latency_max'] * 1000:.1f} ms")
+        self.fanout.close()
+        if self.bus:
+            self.bus.close()
+    
+    def _stop(self):
+        print("[SERVER] Shutdown requested by another shard.")
+        self.running = False
     
     def _handle_connections(self):
         while self.running:
@@ -66,15 +101,20 @@ class Server:
                 'sock': client_sock,
                 'addr': client_addr,
                 'name': client_name,
-                'last_heartbeat': time.time(),  
                 'being_kicked': False  
             }
             
-            with self.clients_lock:
-                self.clients.append(client)
+            if not self.clients.add(client):
+                print(f"[SERVER] Username '{client_name}' is already taken. Closing connection.")
+                client_sock.send(f"Username '{client_name}' is already taken.".encode())
+                client_sock.close()
+                return
+            
+            self.fanout.add(client_sock, client_name)
+            self._schedule_heartbeat_check(client, HEARTBEAT_TIMEOUT)
             
             welcome_msg = f"Welcome to the chat, {client_name}!"
-            client_sock.send(welcome_msg.encode())
+            self.fanout.send(client_sock, welcome_msg.encode())
             
             self.broadcast_message("SERVER", f"{client_name} has joined the chat.")
             
@@ -109,8 +149,7 @@ class Server:
                         print(f"[SERVER] Client {client_name} disconnected (empty message).")
                         break
                     
-                    client['last_heartbeat'] = time.time()
-                    
+                    # Older clients still send these; liveness now comes from transport keepalives
                     if client_message == "__HEARTBEAT__":
                         print(f"[SERVER] Received heartbeat from {client_name}")
                         continue
@@ -122,21 +161,15 @@ class Server:
                         break
                     if client_message.startswith('!rename'):
                         new_name = client_message.split(' ', 1)[1].strip()
-                        if new_name:
-                            with self.clients_lock:
-                                for c in self.clients:
-                                    if c['name'] == new_name and c != client:
-                                        client_sock.send(f"Username '{new_name}' is already taken.".encode())
-                                        continue
-                                client['name'] = new_name
+                        if not new_name:
+                            self.fanout.send(client_sock, "Invalid rename command. Usage: !rename <new_name>".encode())
+                        elif not self.clients.rename(client, new_name):
+                            self.fanout.send(client_sock, f"Username '{new_name}' is already taken.".encode())
+                        else:
+                            self.fanout.rename(client_sock, new_name)
                             print(f"[SERVER] Client {client_name} changed name to {new_name}.")
                             self.broadcast_message("SERVER", f"{client_name} has changed their name to {new_name}.")
-                            for client_new in self.clients:
-                                if client_new['sock'] == client_sock:
-                                    client_new['name'] = new_name
                             client_name = new_name
-                        else:
-                            client_sock.send("Invalid rename command. Usage: !rename <new_name>".encode())
                         continue
                     if client_message.startswith('!kill'):
                         password = client_message.split(' ', 1)[1].strip() if ' ' in client_message else ''
@@ -144,17 +177,18 @@ class Server:
                             print("[SERVER] Server shutdown requested via !kill command.")
                             self.running = False
                             self.broadcast_message("SERVER", "Server is shutting down.")
-                            client_sock.send("Server is shutting down.".encode())
+                            if self.bus:
+                                self.bus.publish('shutdown')
+                            self.fanout.send(client_sock, "Server is shutting down.".encode())
                             break
                         else:
                             continue
 
-                    with self.clients_lock:
-                        if client not in self.clients or client.get('being_kicked', False):
-                            break
+                    if client not in self.clients or client.get('being_kicked', False):
+                        break
                     
                     print(f"[SERVER] Message from {client_name}: {client_message}")
-                    self.broadcast_message(client_name, client_message)
+                    self.broadcast_message(client_name, client_message, client)
 
                     
                 except UnicodeDecodeError as e:
@@ -168,75 +202,105 @@ class Server:
             print(f"[SERVER] Error in handle_client for {client_name}: {e}")
         
         finally:
-            if client.get('being_kicked', False):
+            # A FIN from the peer, a receive error or a kick all end up here; only
+            # a server shutdown leaves the room as it is. Cleanup runs once, so a
+            # client something else already removed is skipped.
+            if self.running or client.get('being_kicked', False):
                 self._cleanup_client(client)
     
     def _cleanup_client(self, client):
+        # Disconnects, kicks and heartbeat timeouts can race; only the first one cleans up
+        if not self.clients.remove(client):
+            return
+        
         client_name = client['name']
         print(f"[SERVER] Client {client_name} disconnected.")
         
-        broadcast_thread = Thread(
-            target=self.broadcast_message, 
-            args=("SERVER", f"{client_name} has left the chat."),
-            daemon=True
-        )
-        broadcast_thread.start()
-        
-        with self.clients_lock:
-            try:
-                if client in self.clients:
-                    self.clients.remove(client)
-            except ValueError:
-                pass
+        self.broadcast_message("SERVER", f"{client_name} has left the chat.")
+        self.fanout.remove(client['sock'])
         
         try:
             client['sock'].close()
         except:
             pass
     
-    def broadcast_message(self, sender_name, message):
-        with self.clients_lock:
-            clients_copy = self.clients.copy()
-        
-        for client in clients_copy:
-            if client.get('being_kicked', False):
-                continue
-            
-            if client['name'] == sender_name and sender_name != "SERVER":
-                continue
-            
-            try:
-                formatted_message = f"{sender_name}: {message}"
-                client['sock'].send(formatted_message.encode())
-            except Exception as e:
-                # Only log the error, don't remove the client here
-                print(f"[SERVER] Failed to send to {client['name']}: {e}")
-    def _monitor_heartbeat(self):
-        while self.running:
+    def broadcast_message(self, sender_name, message, sender=None):
+        # sender is the local client that wrote the message, if any
+        self._broadcast_local(sender_name, message, sender)
+        if self.bus:
             try:
-                current_time = time.time()
-                clients_to_remove = []
-                
-                with self.clients_lock:
-                    clients_copy = self.clients.copy() 
-                
-                for client in clients_copy:
-                    if client.get('being_kicked', False):
-                        continue
-                        
-                    last_heartbeat = client.get('last_heartbeat', current_time)
-                    if current_time - last_heartbeat > 30.0:
-                        print(f"[SERVER] {client['name']} timed out (no heartbeat for {current_time - last_heartbeat:.1f}s)")
-                        self.broadcast_message("SERVER", f"{client['name']} menghilang dari Tubes, {client['name']} tercallout di X!")
-                        clients_to_remove.append(client)
-                
-                for client in clients_to_remove:
-                    self._cleanup_client(client)
-                
-                time.sleep(1)
-            except Exception as e:
-                print(f"[SERVER] Error in heartbeat monitor: {e}")
+                self.bus.publish('broadcast', sender=sender_name, message=message)
+            except ValueError as e:
+                print(f"[SERVER] Message from {sender_name} not sent to other shards: {e}")
+    
+    def _broadcast_local(self, sender_name, message, sender=None):
+        # Names are only unique within a shard, so the sender is skipped by its
+        # connection; a message from another shard has no sender here
+        recipients = [client['sock'] for client in self.clients.snapshot()
+                      if client is not sender and not client.get('being_kicked', False)]
+        
+        # Encoded, chunked and CRC'd once for the whole room; queued per client
+        # and returns at once, send failures are logged by the outboxes
+        formatted_message = PreparedMessage(f"{sender_name}: {message}".encode())
+        self.fanout.publish(formatted_message, recipients)
+
+    def _schedule_heartbeat_check(self, client, delay):
+        self.socket.timers.schedule(delay, self._check_heartbeat, client)
+
+    def _check_heartbeat(self, client):
+        # Runs on the socket's timer wheel, once per client per timeout instead
+        # of scanning every client each second. Liveness comes from the
+        # transport: any segment, keepalives included, counts as a heartbeat.
+        if not self.running or client.get('being_kicked', False) or client.get('removed', False):
+            return
+        
+        idle = client['sock'].idle_time()
+        if idle <= HEARTBEAT_TIMEOUT:
+            # Heard from since this check was armed; look again when it could next expire
+            self._schedule_heartbeat_check(client, HEARTBEAT_TIMEOUT - idle)
+            return
+        
+        # Quick enough for the timer thread: the broadcast only queues on the
+        # outboxes and closing hands its FIN retransmissions to the wheel
+        self._heartbeat_timed_out(client, idle)
+
+    def _heartbeat_timed_out(self, client, idle):
+        try:
+            print(f"[SERVER] {client['name']} timed out (nothing heard for {idle:.1f}s)")
+            self.broadcast_message("SERVER", f"{client['name']} menghilang dari Tubes, {client['name']} tercallout di X!")
+            self._cleanup_client(client)
+        except Exception as e:
+            print(f"[SERVER] Error in heartbeat monitor: {e}")
+
+def _run_shard(HOST, PORT, shard_id, shard_count, bus_dir):
+    bus = ShardBus(bus_dir, shard_id, shard_count)
+    print(f"[SERVER] Shard {shard_id}/{shard_count} starting")
+    Server(HOST, PORT, reuse_port=True, bus=bus).listen()
+
+def run_sharded(HOST, PORT, workers):
+    # One process per shard, each with its own socket, receiver thread and GIL
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("SO_REUSEPORT is not available on this platform")
+    
+    bus_dir = tempfile.mkdtemp(prefix='chat-shards-')
+    shards = [multiprocessing.Process(target=_run_shard, args=(HOST, PORT, i, workers, bus_dir))
+              for i in range(workers)]
+    try:
+        for shard in shards:
+            shard.start()
+        for shard in shards:
+            shard.join()
+    except KeyboardInterrupt:
+        # The shards got the same SIGINT and shut themselves down
+        for shard in shards:
+            shard.join()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
 
 if __name__ == "__main__":
-    server = Server('127.0.0.1', 9000)
-    server.listen()
\ No newline at end of file
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if workers > 1:
+        run_sharded('127.0.0.1', 9000, workers)
+    else:
+        server = Server('127.0.0.1', 9000)
+        server.listen()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+import os
+import socket
+import threading
+from typing import Callable, Dict
+
+BUS_TIMEOUT = 1.0
+BUS_MAX_MESSAGE = 65536  # receive buffer size; a larger datagram would arrive truncated
+
+
+class ShardBus:
+    # Local IPC between server shards: one Unix datagram socket per shard in a
+    # shared directory. publish() sends to every other shard; Unix datagrams
+    # are reliable and ordered, and a full peer queue blocks the sender for at
+    # most BUS_TIMEOUT. Handlers run on the bus thread.
+    def __init__(self, directory: str, shard_id: int, shard_count: int):
+        self.shard_id = shard_id
+        self.path = self._shard_path(directory, shard_id)
+        self.peers = [self._shard_path(directory, i) for i in range(shard_count) if i != shard_id]
+        self.handlers: Dict[str, Callable[[dict], None]] = {}
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(BUS_TIMEOUT)
+        self.running = True
+
+        self.thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _shard_path(directory, shard_id):
+        return os.path.join(directory, f"shard-{shard_id}.sock")
+
+    def subscribe(self, kind: str, handler: Callable[[dict], None]):
+        self.handlers[kind] = handler
+
+    def publish(self, kind: str, **fields):
+        data = json.dumps({'kind': kind, 'shard': self.shard_id, **fields}).encode()
+        if len(data) > BUS_MAX_MESSAGE:
+            raise ValueError(f"Bus message too large ({len(data)} bytes, limit {BUS_MAX_MESSAGE})")
+        for peer in self.peers:
+            try:
+                self.sock.sendto(data, peer)
+            except OSError as e:
+                # Peer not up yet, or already gone
+                print(f"[BUS {self.shard_id}] Failed to reach {peer}: {e}")
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data = self.sock.recv(BUS_MAX_MESSAGE)
+                message = json.loads(data.decode())
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            except ValueError as e:
+                print(f"[BUS {self.shard_id}] Bad message: {e}")
+                continue
+
+            handler = self.handlers.get(message.get('kind'))
+            if handler is None:
+                continue
+            try:
+                handler(message)
+            except Exception as e:
+                print(f"[BUS {self.shard_id}] Error in handler: {e}")
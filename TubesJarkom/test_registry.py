@@ -0,0 +1,67 @@
+import unittest
+
+from registry import ClientRegistry
+
+
+def _client(name, port):
+    return {'sock': object(), 'addr': ('127.0.0.1', port), 'name': name}
+
+
+class ClientRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = ClientRegistry()
+        self.alice = _client('alice', 5000)
+        self.bob = _client('bob', 5001)
+        self.assertTrue(self.registry.add(self.alice))
+        self.assertTrue(self.registry.add(self.bob))
+
+    def test_add_rejects_taken_name(self):
+        self.assertFalse(self.registry.add(_client('alice', 5002)))
+        self.assertEqual(len(self.registry), 2)
+        self.assertIs(self.registry.get_by_name('alice'), self.alice)
+
+    def test_lookups(self):
+        self.assertIs(self.registry.get_by_addr(('127.0.0.1', 5001)), self.bob)
+        self.assertIs(self.registry.get_by_sock(self.alice['sock']), self.alice)
+        self.assertIn(self.alice, self.registry)
+        self.assertEqual(self.registry.snapshot(), (self.alice, self.bob))
+
+    def test_rename_claims_free_name(self):
+        self.assertTrue(self.registry.rename(self.bob, 'carol'))
+        self.assertEqual(self.bob['name'], 'carol')
+        self.assertIs(self.registry.get_by_name('carol'), self.bob)
+        self.assertIsNone(self.registry.get_by_name('bob'))
+        self.assertIn(self.bob, self.registry.snapshot())
+
+    def test_rename_rejects_taken_name(self):
+        self.assertFalse(self.registry.rename(self.bob, 'alice'))
+        self.assertEqual(self.bob['name'], 'bob')
+        self.assertIs(self.registry.get_by_name('alice'), self.alice)
+        self.assertTrue(self.registry.rename(self.bob, 'bob'))
+
+    def test_remove_runs_once_and_frees_name(self):
+        self.assertTrue(self.registry.remove(self.bob))
+        self.assertFalse(self.registry.remove(self.bob))
+        self.assertTrue(self.bob['removed'])
+        self.assertNotIn(self.bob, self.registry)
+        self.assertEqual(self.registry.snapshot(), (self.alice,))
+        self.assertIsNone(self.registry.get_by_addr(self.bob['addr']))
+
+        # A client leaving must not keep its name from the next one to join
+        self.assertTrue(self.registry.add(_client('bob', 5003)))
+
+    def test_removed_client_cannot_rename(self):
+        self.registry.remove(self.bob)
+        self.assertFalse(self.registry.rename(self.bob, 'carol'))
+        self.assertIsNone(self.registry.get_by_name('carol'))
+
+    def test_remove_keeps_newer_client_at_same_address(self):
+        self.registry.remove(self.bob)
+        newer = _client('bob', 5001)
+        self.registry.add(newer)
+        self.assertFalse(self.registry.remove(self.bob))
+        self.assertIs(self.registry.get_by_addr(('127.0.0.1', 5001)), newer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import random
+import struct
+import unittest
+
+from custom_socket import (ACK, FIN, SYN, TERM, CRC16_POLYNOMIAL, MAX_SACK_BLOCKS, Segment, _sack_ranges,
+                           checksum_with_payload, crc16, decode_coalesced, decode_sack_blocks, encode_coalesced,
+                           encode_sack_blocks, internet_checksum, payload_sum)
+
+
+def _bitwise_crc16(data) -> int:
+    # The original Segment._calculate_crc16 loop
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ CRC16_POLYNOMIAL
+            else:
+                crc >>= 1
+    return crc & 0xFFFF
+
+
+def _word_checksum(data) -> int:
+    # The original Segment._calculate_checksum loop: 16-bit words, end-around carry
+    data = bytes(data)
+    if len(data) % 2 == 1:
+        data += b'\x00'
+    checksum = 0
+    for i in range(0, len(data), 2):
+        checksum += (data[i] << 8) + data[i + 1]
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    return ~checksum & 0xFFFF
+
+
+def _payloads():
+    rng = random.Random(1)
+    payloads = [b'', b'\x00', b'\xff', b'\xff' * 111, b'\xff' * 112, b'\x00' * 64, b'hello', bytes(range(256))]
+    payloads += [bytes(rng.getrandbits(8) for _ in range(rng.randrange(1, 1500))) for _ in range(50)]
+    return payloads
+
+
+# Segment.pack() output from before the table-driven CRC and whole-buffer checksum
+PACK_VECTORS = [
+    ((SYN, 5000, 9000, 1234, 0, b''), '0113882328000004d2000000007cc4ffff'),
+    ((ACK, 9000, 5000, 1, 1235, b''), '022328138800000001000004d379c4ffff'),
+    ((TERM, 5000, 9000, 1235, 0, b'hello'), '0813882328000004d300000000a28034f668656c6c6f'),
+    ((0, 65535, 1, 0xFFFFFFFF, 0xFFFFFFFF, bytes(range(111))),
+     '00ffff0001ffffffffffffffff21ec28b7' + bytes(range(111)).hex()),
+    ((FIN | ACK, 1, 2, 3, 4, b'\xff' * 7), '06000100020000000300000004ef008015ffffffffffffff'),
+]
+
+
+class Crc16Test(unittest.TestCase):
+    def test_matches_bitwise_loop(self):
+        for data in _payloads():
+            self.assertEqual(crc16(data), _bitwise_crc16(data), len(data))
+            self.assertEqual(crc16(memoryview(data)), _bitwise_crc16(data), len(data))
+
+    def test_chains_across_odd_splits(self):
+        for data in _payloads():
+            split = len(data) // 3 | 1
+            self.assertEqual(crc16(data[split:], crc16(data[:split])), _bitwise_crc16(data), len(data))
+
+
+class ChecksumTest(unittest.TestCase):
+    def test_matches_word_sum(self):
+        for data in _payloads():
+            self.assertEqual(internet_checksum(data), _word_checksum(data), len(data))
+
+    def test_chunks_match_whole_buffer(self):
+        for data in _payloads():
+            for split in (0, 1, len(data) // 2, len(data)):
+                self.assertEqual(internet_checksum(data[:split], data[split:]), _word_checksum(data), (len(data), split))
+
+    def test_checksum_with_payload(self):
+        for data in _payloads():
+            for header in (b'', b'\x00' * 13, struct.pack('!BHHII', ACK, 5000, 9000, 7, 9), b'\xff' * 13):
+                self.assertEqual(checksum_with_payload(header, payload_sum(data)), _word_checksum(header + data),
+                                 (len(header), len(data)))
+
+
+class SegmentTest(unittest.TestCase):
+    def test_pack_vectors(self):
+        for fields, expected in PACK_VECTORS:
+            self.assertEqual(Segment(*fields).pack().hex(), expected, fields[:5])
+
+    def test_unpack_vectors(self):
+        for fields, expected in PACK_VECTORS:
+            segment = Segment.unpack(bytes.fromhex(expected))
+            self.assertEqual((segment.flags, segment.src_port, segment.dest_port, segment.seq, segment.ack,
+                              bytes(segment.data)), fields)
+
+    def test_prepared_segment_packs_the_same(self):
+        for data in _payloads():
+            plain = Segment(TERM, 5000, 9000, 42, 0, data).pack()
+            prepared = Segment(TERM, 5000, 9000, 42, 0, data, (payload_sum(data), crc16(data))).pack()
+            self.assertEqual(prepared, plain, len(data))
+
+    def test_unpack_rejects_corruption(self):
+        wire = bytearray(Segment(TERM, 5000, 9000, 1235, 0, b'hello').pack())
+        for offset in range(len(wire)):
+            corrupted = bytearray(wire)
+            corrupted[offset] ^= 0x01
+            with self.assertRaises(ValueError):
+                Segment.unpack(bytes(corrupted))
+
+
+class SackTest(unittest.TestCase):
+    def test_ranges_put_latest_block_first(self):
+        buffered = {5, 6, 7, 10, 12, 13}
+        self.assertEqual(_sack_ranges(buffered, 10), [(10, 11), (12, 14), (5, 8)])
+        self.assertEqual(_sack_ranges(buffered, 6), [(5, 8), (12, 14), (10, 11)])
+        self.assertEqual(_sack_ranges(set(), 3), [])
+
+    def test_blocks_round_trip(self):
+        blocks = [(10, 11), (12, 14), (5, 8), (0xFFFFFFF0, 0xFFFFFFFF)]
+        self.assertEqual(decode_sack_blocks(encode_sack_blocks(blocks)), blocks)
+        self.assertEqual(decode_sack_blocks(memoryview(encode_sack_blocks(blocks))), blocks)
+
+    def test_blocks_are_capped(self):
+        blocks = [(seq, seq + 1) for seq in range(0, 20, 2)]
+        self.assertEqual(decode_sack_blocks(encode_sack_blocks(blocks)), blocks[:MAX_SACK_BLOCKS])
+
+    def test_decode_ignores_trailing_partial_block(self):
+        data = encode_sack_blocks([(1, 2), (4, 6)])
+        self.assertEqual(decode_sack_blocks(data + b'\x00\x01\x02'), [(1, 2), (4, 6)])
+        self.assertEqual(decode_sack_blocks(data[:-1]), [(1, 2)])
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_round_trip(self):
+        messages = [b'hi', b'', b'x' * 1024, bytes(range(256))]
+        self.assertEqual(decode_coalesced(encode_coalesced(messages)), messages)
+        self.assertEqual(decode_coalesced(memoryview(encode_coalesced(messages))), messages)
+        self.assertEqual(decode_coalesced(b''), [])
+
+    def test_decode_rejects_truncated_message(self):
+        data = encode_coalesced([b'hello', b'world'])
+        with self.assertRaises(ValueError):
+            decode_coalesced(data[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from timer_wheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.005, slots=8)
+        self.fired = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def _record(self, name, started):
+        self.fired.append((name, time.monotonic() - started))
+        if name == 'last':
+            self.done.set()
+
+    def test_fires_in_deadline_order(self):
+        started = time.monotonic()
+        for name, delay in (('last', 0.09), ('first', 0.01), ('second', 0.03)):
+            self.wheel.schedule(delay, self._record, name, started)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual([name for name, _ in self.fired], ['first', 'second', 'last'])
+        for (name, elapsed), delay in zip(self.fired, (0.01, 0.03, 0.09)):
+            self.assertGreaterEqual(elapsed, delay, name)
+
+    def test_delay_longer_than_one_revolution(self):
+        # 8 slots of 5 ms turn in 40 ms, so this waits out several rounds
+        started = time.monotonic()
+        self.wheel.schedule(0.15, self._record, 'last', started)
+        self.assertTrue(self.done.wait(2))
+        self.assertGreaterEqual(self.fired[0][1], 0.15)
+
+    def test_cancelled_timer_never_fires(self):
+        started = time.monotonic()
+        self.wheel.schedule(0.02, self._record, 'cancelled', started).cancel()
+        self.wheel.schedule(0.05, self._record, 'last', started)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual([name for name, _ in self.fired], ['last'])
+        self.assertEqual(self.wheel.pending, 0)
+
+    def test_shorter_timer_wakes_a_sleeping_wheel(self):
+        started = time.monotonic()
+        self.wheel.schedule(1.0, self._record, 'long', started)
+        time.sleep(0.02)
+        self.wheel.schedule(0.02, self._record, 'last', started)
+        self.assertTrue(self.done.wait(0.5))
+        self.assertEqual([name for name, _ in self.fired], ['last'])
+
+    def test_callback_error_does_not_stop_the_wheel(self):
+        def fail():
+            raise RuntimeError("boom")
+        started = time.monotonic()
+        self.wheel.schedule(0.01, fail)
+        self.wheel.schedule(0.03, self._record, 'last', started)
+        self.assertTrue(self.done.wait(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import math
+import threading
+import time
+from typing import Callable, List
+
+TICK = 0.005  # seconds per slot, well below MIN_RTO and the delayed-ACK timer
+SLOTS = 512   # one revolution covers 2.56 s; longer delays wait out extra rounds
+
+
+class Timer:
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback: Callable, args: tuple, rounds: int):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        # Dropped lazily when the wheel next reaches its slot. A timer cancelled
+        # while it is being dispatched may still fire once, so callbacks
+        # check that their work is still due.
+        self.cancelled = True
+
+
+class TimerWheel:
+    # Hashed timing wheel (Varghese & Lauck): scheduling and cancelling are
+    # O(1) however many connections share it. The thread sleeps until the
+    # next slot holding a timer rather than waking every tick, so long timers
+    # like keepalives cost a couple of wakeups each, not one per TICK.
+    # Callbacks run on the wheel's thread and must return quickly.
+    def __init__(self, tick: float = TICK, slots: int = SLOTS):
+        self.tick = tick
+        self.slots: List[List[Timer]] = [[] for _ in range(slots)]
+        self.current = 0
+        self.current_time = time.monotonic()  # when the wheel reached slot `current`
+        self.wake_time = None  # when the sleeping thread next looks at the wheel
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        with self.condition:
+            now = time.monotonic()
+            if not self.pending:
+                # The wheel stopped turning while idle; restart it from now
+                self.current_time = now
+            
+            # Counted from the slot the wheel last reached, which lags real
+            # time while the thread sleeps
+            ticks = max(1, math.ceil((now + delay - self.current_time) / self.tick))
+            timer = Timer(callback, args, (ticks - 1) // len(self.slots))
+            self.slots[(self.current + ticks) % len(self.slots)].append(timer)
+            self.pending += 1
+            
+            due = self.current_time + ticks * self.tick
+            if self.pending == 1 or (self.wake_time is not None and due < self.wake_time):
+                self.condition.notify()
+        return timer
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                # Nothing scheduled: sleep until something is
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                
+                # schedule() wakes us early if it adds a timer before this
+                self.wake_time = self.current_time + self._ticks_to_next_timer() * self.tick
+                delay = self.wake_time - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                self.wake_time = None
+                due = self._advance(time.monotonic())
+
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    print(f"[TIMER] Error in timer callback: {e}")
+
+    def _ticks_to_next_timer(self) -> int:
+        # Caller holds condition and pending > 0
+        count = len(self.slots)
+        for ticks in range(1, count + 1):
+            if self.slots[(self.current + ticks) % count]:
+                return ticks
+        return count
+
+    def _advance(self, now: float) -> List[Timer]:
+        # Caller holds condition: visit every slot whose time has come
+        due = []
+        while self.current_time + self.tick <= now:
+            self.current = (self.current + 1) % len(self.slots)
+            self.current_time += self.tick
+            
+            slot = self.slots[self.current]
+            if not slot:
+                continue
+            waiting = []
+            for timer in slot:
+                if timer.cancelled:
+                    self.pending -= 1
+                elif timer.rounds:
+                    timer.rounds -= 1
+                    waiting.append(timer)
+                else:
+                    self.pending -= 1
+                    due.append(timer)
+            self.slots[self.current] = waiting
+        return due